@@ -0,0 +1,198 @@
+"""Per-user rate limiting and fair scheduling in front of the Gemini API.
+
+Each key (a user id, or a guest session) has a token bucket; a request that finds
+its bucket empty is rejected with a retry-after hint. Admitted requests go through
+a global scheduler with a cap on requests in flight; when a slot frees up it is
+handed to the next key in round-robin order, so one busy user can't starve others.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after, reason="rate"):
+        super().__init__(f"retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def take(self, now):
+        # Returns 0 if a token was taken, else seconds until one is available
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Ticket:
+    def __init__(self, controller, key):
+        self._controller = controller
+        self.key = key
+        self.granted = False
+        self.done = False
+        self.deadline = time.monotonic() + controller.queue_timeout
+
+    def wait(self, timeout=None):
+        """True once the ticket holds an in-flight slot; raises RateLimited if it waited too long."""
+        return self._controller._wait(self, timeout)
+
+    def position(self):
+        return self._controller._position(self)
+
+    def release(self):
+        self._controller._release(self)
+
+    def __enter__(self):
+        self.wait()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    def __init__(self, rate=0.5, burst=5, max_in_flight=8, max_queue=200,
+                 queue_timeout=60.0, idle_bucket_ttl=3600.0):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.idle_bucket_ttl = idle_bucket_ttl
+        self.in_flight = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queued_total = 0
+        self._buckets = {}
+        self._queues = OrderedDict()  # key -> deque[Ticket]; order is the round-robin rotation
+        self._cond = threading.Condition()
+        self._last_sweep = time.monotonic()
+
+    def admit(self, key):
+        """Takes a token for `key` and returns a Ticket; raises RateLimited when over the limit."""
+        now = time.monotonic()
+        with self._cond:
+            self._sweep(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst, now)
+            wait = bucket.take(now)
+            if wait:
+                self.rejected += 1
+                raise RateLimited(wait)
+            if self.in_flight >= self.max_in_flight and self.queued() >= self.max_queue:
+                bucket.tokens += 1  # not the user's fault; give the token back
+                self.rejected += 1
+                raise RateLimited(self.queue_timeout / 4, reason="busy")
+
+            ticket = Ticket(self, key)
+            self.admitted += 1
+            if self.in_flight < self.max_in_flight and not self._queues:
+                ticket.granted = True
+                self.in_flight += 1
+            else:
+                self._queues.setdefault(key, deque()).append(ticket)
+                self.queued_total += 1
+            return ticket
+
+    def queued(self):
+        with self._cond:
+            return sum(len(q) for q in self._queues.values())
+
+    def stats(self):
+        with self._cond:
+            return {
+                "in_flight": self.in_flight,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "admitted": self.admitted,
+                "queued_total": self.queued_total,
+                "rejected": self.rejected,
+            }
+
+    def _wait(self, ticket, timeout):
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not ticket.granted:
+                now = time.monotonic()
+                if now >= ticket.deadline:
+                    self._dequeue(ticket)
+                    ticket.done = True
+                    self.rejected += 1
+                    raise RateLimited(self.queue_timeout / 4, reason="busy")
+                if end is not None and now >= end:
+                    return False
+                limit = ticket.deadline if end is None else min(end, ticket.deadline)
+                self._cond.wait(limit - now)
+            return True
+
+    def _position(self, ticket):
+        # 1-based place in line under round-robin: everything ahead in our own queue,
+        # plus up to that many (+1 for keys ahead of us in the rotation) from every other key
+        with self._cond:
+            if ticket.granted or ticket.done:
+                return 0
+            own = self._queues.get(ticket.key)
+            if not own or ticket not in own:
+                return 0
+            index = own.index(ticket)
+            ahead = index
+            before_us = True
+            for key, queue in self._queues.items():
+                if key == ticket.key:
+                    before_us = False
+                    continue
+                ahead += min(len(queue), index + (1 if before_us else 0))
+            return ahead + 1
+
+    def _release(self, ticket):
+        with self._cond:
+            if ticket.done:
+                return
+            ticket.done = True
+            if ticket.granted:
+                self.in_flight -= 1
+                self._grant_next()
+            else:
+                self._dequeue(ticket)
+
+    def _dequeue(self, ticket):
+        queue = self._queues.get(ticket.key)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+            if not queue:
+                del self._queues[ticket.key]
+
+    def _grant_next(self):
+        while self.in_flight < self.max_in_flight and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            # move this key to the back of the rotation
+            del self._queues[key]
+            if queue:
+                self._queues[key] = queue
+            ticket.granted = True
+            self.in_flight += 1
+        self._cond.notify_all()
+
+    def _sweep(self, now):
+        # drop buckets that have been full and idle for a while so the dict doesn't grow forever
+        if now - self._last_sweep < 60:
+            return
+        self._last_sweep = now
+        stale = [k for k, b in self._buckets.items()
+                 if now - b.updated > self.idle_bucket_ttl and k not in self._queues]
+        for k in stale:
+            del self._buckets[k]
@@ -1,68 +1,300 @@
 import streamlit as st
-import requests
 import os
-import time
 from dotenv import load_dotenv
-import firebase_admin
-from firebase_admin import auth
-from google.cloud import firestore
 import uuid
 import json
-import streamlit_authenticator
-import yaml
-from yaml.loader import SafeLoader
-import hashlib
+import threading
+import time
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+import metrics
+from gemini_client import GEMINI_BASE_URL, GeminiClient, GeminiError
+import chat_context
+import chat_render
+from admission import AdmissionController, RateLimited
+from generation import Generation
+from guest_store import GuestStore
+import session_token
+from response_cache import ResponseCache, make_key as make_response_key
+# The Firestore/auth stack (google.cloud, firebase_admin, yaml, ...) is imported in the
+# login branch below, so the landing page and guest mode never pay for it.
 
 # ========== CHAT FUNCTIONS (unchanged) ==========
 
-def save_chat(user_id, chat_id, chat_title, messages):
-    if not chat_title and messages:
-        chat_title = messages[0]["text"][:30]
-    db = get_db()
-    chat_ref = db.collection('users').document(user_id).collection('chats').document(chat_id)
-    chat_ref.set({
-        'created_at': firestore.SERVER_TIMESTAMP,
-        'title': chat_title,
-        'messages': messages
-    })
-
-def list_user_chats(user_id):
-    db = get_db()
-    chats_ref = db.collection('users').document(user_id).collection('chats')
-    chats = chats_ref.order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-    chat_list = []
-    for c in chats:
-        data = c.to_dict()
-        chat_list.append({
-            'id': c.id,
-            'title': data.get('title', 'Untitled'),
-            'created_at': data.get('created_at'),
-            'messages': data.get('messages', [])
-        })
-    return chat_list
+def persist_chat(user_id):
+    # Only writes when the conversation changed since the last save, so idle reruns are free
+    if not st.session_state.chat_dirty:
+        return
+    chat_id = st.session_state.chat_id
+    history = st.session_state.chat_history
+    if not st.session_state.chat_title and len(history) >= 2:
+        request_chat_title(user_id, chat_id, history[:2])
+    writes = get_write_queue()
+    base = st.session_state.chat_base  # seq of chat_history[0]; >0 when older turns aren't loaded
+    saved = st.session_state.saved_count
+    if base + len(history) < saved:
+        # conversation was cleared: start the stored transcript over
+        writes.clear(user_id, chat_id)
+        saved = 0
+    # append-only: just the turns that were not stored yet; written in the background, where
+    # their stored seqs are reserved, so another tab on the same chat can't overwrite them
+    # a new chat is stored titled after its first message until request_chat_title's answer lands
+    writes.save(user_id, chat_id, st.session_state.chat_title or None,
+                history[saved - base:], first_seq=saved)
+    st.session_state.saved_count = base + len(history)
+    st.session_state.chat_dirty = False
+
+def start_chat(chat_id=None, title="", history=None, base=0):
+    discard_generation()
+    st.session_state.chat_id = chat_id or str(uuid.uuid4())
+    st.session_state.chat_title = title
+    st.session_state.chat_history = history or []
+    st.session_state.chat_base = base
+    st.session_state.saved_count = base + len(st.session_state.chat_history)
+    st.session_state.chat_dirty = False
+
+def open_chat(user_id, chat):
+    # Only the newest page of messages is fetched; older ones load on demand
+    get_write_queue().flush()  # read our own queued writes
+    messages, first_seq = chat_store.load_chat_messages(get_db(), user_id, chat['id'])
+    title = chat.get('title')
+    if title is None:
+        title = chat_store.load_chat_title(get_db(), user_id, chat['id'])
+    start_chat(chat['id'], title, messages, first_seq)
+
+def load_older_messages(user_id):
+    older, first_seq = chat_store.load_chat_messages(
+        get_db(), user_id, st.session_state.chat_id, before_seq=st.session_state.chat_base)
+    st.session_state.chat_history = older + st.session_state.chat_history
+    st.session_state.chat_base = first_seq
+
+def request_chat_title(user_id, chat_id, messages):
+    # Generates the title once per chat_id on a worker thread, behind the same admission
+    # control as answers, and applies it as a queued title update
+    requested = st.session_state.chat_titles
+    if chat_id in requested:
+        return
+    requested.add(chat_id)
+    try:
+        ticket = get_admission().admit(f"user:{user_id}")
+    except RateLimited:
+        return  # keeps the first-message title
+    get_gemini_client(), get_response_cache()  # create shared resources on the script thread
+    writes = get_write_queue()
 
+    def run():
+        try:
+            with ticket:
+                title = get_gemini_title(messages)
+        except RateLimited:
+            return
+        if title and not title.startswith("Error:") and title != "No response from Gemini.":
+            writes.update_title(user_id, chat_id, title)
+    thread = threading.Thread(target=run, name="chat-title", daemon=True)
+    add_script_run_ctx(thread, get_script_run_ctx())
+    thread.start()
+
+@metrics.timed("get_gemini_title")
 def get_gemini_title(messages):
-    chat_content = "\n".join([f"{m['role']}: {m['text']}" for m in messages[:2]])
+    return chat_context.clean_title(get_gemini_response(chat_context.title_prompt(messages)))
+
+def summarize_turns(summary, turns):
+    transcript = "\n".join(f"{m['role']}: {m['text']}" for m in turns)
     prompt = (
-        "Summarize this conversation so far with a short, descriptive title (max 8 words):\n"
-        + chat_content
+        "Update the running summary of this conversation with the new messages below. "
+        "Keep names, facts, decisions and open questions. Reply with the summary only, under 150 words.\n\n"
+        f"Current summary:\n{summary or '(none yet)'}\n\nNew messages:\n{transcript}"
     )
-    return get_gemini_response(prompt).strip().replace('"','')
-
-def get_gemini_response(prompt):
-    headers = {"Content-Type": "application/json"}
-    data = {"contents": [{"parts": [{"text": prompt}]}]}
-    response = requests.post(GEMINI_API_URL, headers=headers, json=data)
-    if response.ok:
-        res_json = response.json()
-        try:
-            return res_json['candidates'][0]['content']['parts'][0]['text']
-        except Exception:
-            return "No response from Gemini."
+    text = get_gemini_response(prompt)
+    if text.startswith("Error:") or text == "No response from Gemini.":
+        return None
+    return text.strip()
+
+def chat_contents(chat_id, history, base=0):
+    # Multi-turn request body, bounded by the context token budget
+    return chat_context.build_contents(chat_id, history, base, summarize_turns)
+
+@st.cache_resource
+def get_gemini_client():
+    # One pooled client per process, shared by every browser session
+    return GeminiClient(API_KEY, base_url=os.getenv("GEMINI_API_BASE", GEMINI_BASE_URL))
+
+@st.cache_resource
+def get_response_cache():
+    # Shared by every session; set GEMINI_CACHE_DB to keep answers across restarts
+    cache = ResponseCache(db_path=os.getenv("GEMINI_CACHE_DB"))
+    metrics.register_callback("response_cache_hits_total", lambda: cache.hits, kind="counter")
+    metrics.register_callback("response_cache_misses_total", lambda: cache.misses, kind="counter")
+    return cache
+
+@st.cache_resource
+def get_admission():
+    # Per-user token buckets + a fair queue in front of Gemini, shared by every session
+    admission = AdmissionController(
+        rate=float(os.getenv("GEMINI_USER_RATE", "0.2")),
+        burst=int(os.getenv("GEMINI_USER_BURST", "10")),
+        max_in_flight=int(os.getenv("GEMINI_MAX_IN_FLIGHT", "8")),
+    )
+    metrics.register_callback("admission_in_flight", lambda: admission.stats()["in_flight"])
+    metrics.register_callback("admission_queued", lambda: admission.stats()["queued"])
+    metrics.register_callback("admission_queued_total", lambda: admission.stats()["queued_total"], kind="counter")
+    metrics.register_callback("admission_rejected_total", lambda: admission.stats()["rejected"], kind="counter")
+    return admission
+
+def retry_message(e):
+    seconds = max(1, round(e.retry_after))
+    if e.reason == "busy":
+        return f"Gemini is very busy right now. Please try again in {seconds} s."
+    return f"You're sending messages too quickly. Please wait {seconds} s and try again."
+
+def admit_turn(key):
+    # Ticket for one Gemini turn, or None (with a warning shown) when over the rate limit
+    try:
+        return get_admission().admit(key)
+    except RateLimited as e:
+        st.warning(retry_message(e))
+        return None
+
+def start_generation(chat_id, history, base, ticket):
+    # The answer is produced on a worker thread so the page stays live (and stoppable)
+    get_gemini_client(), get_response_cache()  # create shared resources on the script thread
+    history = list(history)
+
+    def produce(cancel):
+        contents = chat_contents(chat_id, history, base)
+        return stream_gemini_response(contents, cancel=cancel)
+    st.session_state.generation = Generation(produce, ticket).start()
+
+def finish_generation(stopped=False):
+    # Moves the answer (or whatever arrived before Stop) into the history. Failures are
+    # shown as a notice instead, so they're never saved or sent back to Gemini as context.
+    gen = st.session_state.pop("generation", None)
+    if gen is None:
+        return
+    stopped = stopped and not gen.done
+    if stopped:
+        gen.cancel()
+    text = gen.text()
+    if gen.status == "failed":
+        if isinstance(gen.error, RateLimited):
+            st.session_state.generation_notice = ("warning", retry_message(gen.error))
+        else:
+            st.session_state.generation_notice = ("error", f"Gemini couldn't answer: {gen.error}")
+        if not text:
+            return
+        text = f"{text} ⚠️"  # keep the part of the answer that did arrive
+    elif stopped or gen.status == "stopped":
+        text = f"{text} ⏹️" if text else "⏹️ Stopped."
+    append_message("gemini", text)
+    if st.session_state.mode == "login":
+        st.session_state.chat_dirty = True
+
+def append_message(role, text):
+    if st.session_state.mode == "guest":
+        get_guest_store().append(st.session_state.guest_chat_id, role, text)
+    else:
+        st.session_state.chat_history.append({"role": role, "text": text})
+
+def collect_generation():
+    gen = st.session_state.get("generation")
+    if gen is not None and gen.done:
+        finish_generation()
+    notice = st.session_state.pop("generation_notice", None)
+    if notice:
+        kind, text = notice
+        (st.warning if kind == "warning" else st.error)(text)
+
+def discard_generation():
+    # Switching or clearing chats: stop the answer and drop it
+    gen = st.session_state.pop("generation", None)
+    if gen is not None:
+        gen.cancel()
+
+@st.fragment(run_every=chat_render.STREAM_FRAME_INTERVAL)
+def generation_panel():
+    # Polls the worker; only rendered while a generation exists, so the timer stops with it
+    gen = st.session_state.get("generation")
+    if gen is None:
+        return
+    if gen.done:
+        finish_generation()
+        st.rerun()
+    if gen.status == "queued":
+        st.info(f"⏳ Lots of people are chatting right now. You're #{gen.position()} in line...")
     else:
-        return f"Error: {response.text}"
+        st.markdown(chat_render.bubble_html("gemini", gen.text(), cursor=True), unsafe_allow_html=True)
+    if st.button("⏹️ Stop", key="stop_generation"):
+        finish_generation(stopped=True)
+        st.rerun()
+
+@st.cache_resource
+def get_guest_store():
+    # Guest conversations for the whole process, capped per session and in total
+    store = GuestStore(
+        max_messages=int(os.getenv("GUEST_MAX_MESSAGES", "100")),
+        max_session_bytes=int(os.getenv("GUEST_MAX_SESSION_KB", "256")) * 1024,
+        max_total_bytes=int(os.getenv("GUEST_MAX_TOTAL_MB", "256")) * 1024 * 1024,
+        idle_ttl=float(os.getenv("GUEST_IDLE_MINUTES", "30")) * 60,
+        on_evict=chat_context.reset_summary,
+    )
+    metrics.register_callback("guest_session_bytes", lambda: store.total_bytes,
+                              help_text="Memory held by guest conversations.")
+    metrics.register_callback("guest_sessions", lambda: len(store))
+    metrics.register_callback("guest_sessions_evicted_total", lambda: store.evicted, kind="counter")
+    return store
+
+def response_cache_key(contents):
+    prompt = contents[-1]["parts"][0]["text"]
+    return make_response_key(prompt, get_gemini_client().model, contents[:-1])
+
+@metrics.timed("get_gemini_response")
+def get_gemini_response(prompt, use_cache=True):
+    contents = [{"parts": [{"text": prompt}]}]
+    cache = get_response_cache()
+    key = response_cache_key(contents) if use_cache else None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            return cached
+    try:
+        text = get_gemini_client().generate(contents)
+    except GeminiError as e:
+        return f"Error: {e}"
+    if not text:
+        return "No response from Gemini."
+    if key:
+        cache.put(key, text)
+    return text
+
+def stream_gemini_response(contents, use_cache=True, cancel=None):
+    # Yields text chunks as they arrive over SSE from streamGenerateContent
+    cache = get_response_cache()
+    key = response_cache_key(contents) if use_cache else None
+    if key:
+        cached = cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    started = time.perf_counter()
+    try:
+        for text in get_gemini_client().stream(contents, cancel=cancel):
+            if not chunks:
+                metrics.observe("gemini_stream_ttfb", time.perf_counter() - started)
+            chunks.append(text)
+            yield text
+    except GeminiError:
+        metrics.observe("stream_gemini_response", time.perf_counter() - started, error=True)
+        raise  # the generation fails; its error is shown, not added to the chat
+    metrics.observe("stream_gemini_response", time.perf_counter() - started)
+    if cancel is not None and cancel.cancelled():
+        return  # partial answer: don't cache it
+    if not chunks:
+        raise GeminiError("No response from Gemini.")
+    if key:
+        cache.put(key, "".join(chunks))
 
 def verify_firebase_token(token):
+    from firebase_admin import auth
     try:
         decoded_token = auth.verify_id_token(token)
         return decoded_token  # Contains uid, email, etc.
@@ -70,11 +302,9 @@ def verify_firebase_token(token):
         st.error(f"Token verification error: {e}")
         return None
 
-def delete_chat(user_id, chat_id):
-    db = get_db()
-    db.collection('users').document(user_id).collection('chats').document(chat_id).delete()
-
 def load_config():
+    import yaml
+    from yaml.loader import SafeLoader
     if os.path.exists(CONFIG_PATH):
         with open(CONFIG_PATH, 'r') as file:
             config = yaml.load(file, Loader=SafeLoader)
@@ -87,6 +317,7 @@ def load_config():
     return config
 
 def save_config(config):
+    import yaml
     with open(CONFIG_PATH, 'w') as file:
         yaml.dump(config, file)
 
@@ -109,6 +340,7 @@ def hash_password(password):
     # Simple hash with sha256; for real-world, use bcrypt or firebase's built-in auth!
     return hashlib.sha256(password.encode()).hexdigest()
 
+@metrics.timed("authenticate_user")
 def authenticate_user(username, password):
     db = get_db()
     user_doc = db.collection('users').document(username).get()
@@ -117,21 +349,140 @@ def authenticate_user(username, password):
         return hash_password(password) == user_data['password'], user_data
     return False, None
 
+@st.cache_resource
+def get_db_resource():
+    # One Firestore client for the whole process instead of one per browser session
+    resource = FirestoreResource(json.loads(st.secrets["FIREBASE_SERVICE_ACCOUNT"]))
+    resource.warm_up()
+    return resource
+
 def get_db():
-    if not hasattr(st.session_state, 'firestore_db'):
-        # Only initialize if not already present
-        service_account_info = json.loads(st.secrets["FIREBASE_SERVICE_ACCOUNT"])
-        st.session_state.firestore_db = firestore.Client.from_service_account_info(service_account_info)
-    return st.session_state.firestore_db
+    return get_db_resource().client()
+
+@st.cache_resource
+def get_write_queue():
+    # Chat mutations are coalesced and written to Firestore off the script thread
+    queue = chat_store.WriteBehindQueue(get_db_resource().client)
+    metrics.register_callback("write_behind_pending", queue.pending)
+    return queue
+
+@st.cache_resource
+def get_session_signer():
+    # Login-branch only: the key and expiry come from config.yaml's `cookie` section; the
+    # placeholder key is replaced by a random one (saved back) so nobody can sign with it
+    config = load_config()
+    cookie = config.setdefault('cookie', {})
+    key = st.secrets.get("COOKIE_KEY") or cookie.get('key')
+    if not key or key == session_token.DEFAULT_KEY:
+        key = cookie['key'] = session_token.new_key()
+        save_config(config)
+    return session_token.SessionSigner(key, session_token.COOKIE_NAME, cookie.get('expiry_days', 3))
+
+@st.cache_resource
+def get_profile_cache():
+    profiles = session_token.ProfileCache()
+    metrics.register_callback("profile_cache_hits_total", lambda: profiles.hits, kind="counter")
+    metrics.register_callback("profile_cache_misses_total", lambda: profiles.misses, kind="counter")
+    return profiles
+
+def session_cookie():
+    # The login cookie's value, or None. Found by iterating: AppTest (bench/startup.py)
+    # backs st.context.cookies with a mock that answers every key lookup
+    cookies = st.context.cookies
+    if any(name == session_token.COOKIE_NAME for name in cookies):
+        return cookies[session_token.COOKIE_NAME]
+    return None
+
+def has_session_cookie():
+    # Cheap check for the landing page: just the cookie's name, no config, key or yaml
+    return session_cookie() is not None
+
+def get_user_profile(user_id):
+    profiles = get_profile_cache()
+    profile = profiles.get(user_id)
+    if profile is None:
+        snap = get_db().collection('users').document(user_id).get()
+        if not snap.exists:
+            return None
+        profile = profiles.put(user_id, snap.to_dict())
+    return profile
+
+def resume_session():
+    # Logs the browser back in from its signed cookie and reopens the chat it was on
+    signer = get_session_signer()
+    claims = signer.verify(session_cookie())
+    if not claims:
+        return False
+    profile = get_user_profile(claims['u'])
+    if profile is None or claims['iat'] < profile.get('sessions_valid_after', 0):
+        return False
+    st.session_state.logged_in = True
+    st.session_state.user_id = claims['u']
+    st.session_state.session_claims = claims
+    if claims.get('c'):
+        open_chat(claims['u'], {'id': claims['c']})
+        st.session_state.cookie_chat = claims['c']
+    return True
+
+def write_cookie(value, expires_at):
+    script = session_token.cookie_script(get_session_signer().cookie_name, value, expires_at)
+    if hasattr(st, "iframe"):
+        st.iframe(script, height=1)
+    else:  # older streamlit without st.iframe
+        import streamlit.components.v1 as components
+        components.html(script, height=0)
+
+def sync_session_cookie(user_id):
+    # (Re)issues the cookie when the open chat changes, so a refresh comes back right here.
+    # The original iat/exp are kept: switching chats doesn't extend the session.
+    chat_id = st.session_state.chat_id
+    if st.session_state.get("cookie_chat") == chat_id:
+        return
+    signer = get_session_signer()
+    claims = {**(st.session_state.get("session_claims") or signer.new_claims(user_id)), 'c': chat_id}
+    st.session_state.session_claims = claims
+    st.session_state.cookie_chat = chat_id
+    write_cookie(signer.sign(claims), claims['exp'])
+
+def revoke_sessions(user_id):
+    # Logout ends every cookie session issued so far for this user
+    now = time.time()
+    get_db().collection('users').document(user_id).set({'sessions_valid_after': now}, merge=True)
+    get_profile_cache().update(user_id, sessions_valid_after=now)
+
+@st.cache_resource
+def start_metrics_server():
+    # Prometheus scrape endpoint at :$METRICS_PORT/metrics, one per process
+    port = os.getenv("METRICS_PORT")
+    return metrics.serve(int(port)) if port else None
+
+def admin_users():
+    # ADMIN_USERS as a TOML list or a comma-separated string (secrets or env)
+    value = st.secrets.get("ADMIN_USERS") or os.getenv("ADMIN_USERS", "")
+    names = value if isinstance(value, (list, tuple)) else str(value).split(",")
+    return {str(u).strip() for u in names if str(u).strip()}
+
+def is_admin(user_id):
+    return bool(user_id) and user_id in admin_users()
+
+def render_metrics_panel():
+    snap = metrics.snapshot()
+    with st.expander("📈 Metrics"):
+        rows = [
+            {"span": name, "count": s["count"], "errors": s["errors"],
+             "p50 ms": round(s["p50_ms"], 1), "p95 ms": round(s["p95_ms"], 1), "p99 ms": round(s["p99_ms"], 1)}
+            for name, s in sorted(snap["spans"].items())
+        ]
+        if rows:
+            st.table(rows)
+        for name, value in sorted(snap["counters"].items()):
+            st.caption(f"{name}: {value}")
 
 # ========== SECRETS / ENV ==========
-GOOGLE_CLIENT_ID = st.secrets["GOOGLE_CLIENT_ID"]
-GOOGLE_CLIENT_SECRET = st.secrets["GOOGLE_CLIENT_SECRET"]
-MS_CLIENT_ID = st.secrets["MS_CLIENT_ID"]
-MS_CLIENT_SECRET = st.secrets["MS_CLIENT_SECRET"]
-
 CONFIG_PATH = "config.yaml"
 
+start_metrics_server()
+
 # session flags
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
@@ -144,6 +495,10 @@ if "just_logged_in" not in st.session_state:
 if "mode" not in st.session_state:
     st.session_state.mode = None
 
+if st.session_state.mode is None and not st.session_state.get("cookie_checked") and has_session_cookie():
+    st.session_state.mode = "login"  # returning browser: try the signed cookie before anything else
+    st.session_state.cookie_entry = True
+
 if st.session_state.mode is None:
     st.set_page_config(page_title="Gemini Chatbot", page_icon="🤖")
     st.title("🤖 Welcome to Gemini Chatbot")
@@ -162,125 +517,62 @@ if st.session_state.mode is None:
 # ========== Gemini API ==========
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash:generateContent?key={API_KEY}"
 
 # ========== GUEST MODE ==========
 if st.session_state.mode == "guest":
     st.set_page_config(page_title="Gemini Chatbot", page_icon="🤖")
     st.title("🤖 Gemini Chatbot (Guest Mode)")
     st.caption("Chat as a guest (your conversation will NOT be saved)")
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+    if "guest_chat_id" not in st.session_state:
+        st.session_state.guest_chat_id = str(uuid.uuid4())
+    guest_id = st.session_state.guest_chat_id
 
     with st.form(key="chat_form_guest", clear_on_submit=True):
         user_input = st.text_input("Type your message...", key="input_field_guest")
         submitted = st.form_submit_button("Send")
 
-    # Chat bubbles display (unchanged) ...
-    for chat in st.session_state.chat_history:
-        if chat["role"] == "user":
-            st.markdown(
-                f"""
-                <div style="display: flex; justify-content: flex-end; align-items: flex-end; margin: 12px 0;">
-                    <div style="background: #0078fe; color: white; padding: 12px 18px; border-radius: 16px 16px 2px 16px; margin-left: 8px; max-width: 70%; box-shadow: 1px 2px 4px rgba(0,0,0,0.04); font-size: 1.1em; word-break: break-word;">
-                        {chat['text']}
-                    </div>
-                    <div style="margin-left: 6px; font-size: 1.6em;">🧑</div>
-                </div>
-                """,
-                unsafe_allow_html=True)
-        else:
-            st.markdown(
-                f"""
-                <div style="display: flex; justify-content: flex-start; align-items: flex-end; margin: 12px 0;">
-                    <div style="margin-right: 6px; font-size: 1.6em;">🤖</div>
-                    <div style="background: #f1f0f0; color: #222; padding: 12px 18px; border-radius: 16px 16px 16px 2px; margin-right: 8px; max-width: 70%; box-shadow: 1px 2px 4px rgba(0,0,0,0.04); font-size: 1.1em; word-break: break-word;">
-                        {chat['text']}
-                """,
-                unsafe_allow_html=True)
-
-    if submitted and user_input:
-        # (typing animation unchanged)
-        user_placeholder = st.empty()
-        partial_user_text = ""
-        for char in user_input:
-            partial_user_text += char
-            user_placeholder.markdown(
-                f"""
-                <div style='display:flex; justify-content:flex-end; align-items:flex-end; margin:10px 0;'>
-                    <div style='background:#0078fe; color:white; padding:12px 18px; border-radius:16px 16px 2px 16px; max-width:60%; min-height:38px; word-break:break-word;'>
-                        {partial_user_text}<span style="color:#eee;">▌</span>
-                    </div>
-                    <div style='margin-left:8px;font-size:1.5em;'>🧑</div>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-            time.sleep(0.012)
-        user_placeholder.markdown(
-            f"""
-            <div style='display:flex; justify-content:flex-end; align-items:flex-end; margin:10px 0;'>
-                <div style='background:#0078fe; color:white; padding:12px 18px; border-radius:16px 16px 2px 16px; max-width:60%; min-height:38px; word-break:break-word;'>
-                    {user_input}
-                </div>
-                <div style='margin-left:8px;font-size:1.5em;'>🧑</div>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
-
-        st.session_state.chat_history.append({"role": "user", "text": user_input})
-
-        # Gemini response animation (unchanged)
-        bot_placeholder = st.empty()
-        with st.spinner("Gemini is thinking..."):
-            bot_response = get_gemini_response(user_input)
-            partial_bot_text = ""
-            for char in bot_response:
-                partial_bot_text += char
-                bot_placeholder.markdown(
-                    f"""
-                    <div style='display:flex; justify-content:flex-start; align-items:flex-end; margin:10px 0;'>
-                        <div style='margin-right:8px;font-size:1.5em;'>🤖</div>
-                        <div style='background:#f1f0f0; color:#222; padding:12px 18px; border-radius:16px 16px 16px 2px; max-width:60%; min-height:38px; word-break:break-word;'>
-                            {partial_bot_text}<span style="color:#888;">▌</span>
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True
-                )
-                time.sleep(0.012)
-            bot_placeholder.markdown(
-                f"""
-                <div style='display:flex; justify-content:flex-start; align-items:flex-end; margin:10px 0;'>
-                    <div style='margin-right:8px;font-size:1.5em;'>🤖</div>
-                    <div style='background:#f1f0f0; color:#222; padding:12px 18px; border-radius:16px 16px 16px 2px; max-width:60%; min-height:38px; word-break:break-word;'>
-                        {bot_response}
-                    </div>
-                </div>
-                """,
-                unsafe_allow_html=True
-            )
-
-        st.session_state.chat_history.append({"role": "gemini", "text": bot_response})
-        st.rerun()
+    ticket = admit_turn(f"guest:{guest_id}") if submitted and user_input else None
+    if ticket:
+        finish_generation(stopped=True)  # a new message replaces the answer in progress
+        append_message("user", user_input)
+        guest = get_guest_store().get(guest_id)
+        start_generation(guest_id, guest.messages(), guest.base, ticket)
+    collect_generation()
+
+    # the conversation lives in the shared guest store, not in session_state
+    guest = get_guest_store().get(guest_id)
+    if guest.base:
+        st.caption(f"Guest mode keeps only your latest {len(guest)} messages.")
+    chat_render.render_history(guest.messages(), guest_id)
+    if "generation" in st.session_state:
+        generation_panel()
 
     if st.button("⬅️ Back to Home"):
+        discard_generation()
+        chat_context.reset_summary(guest_id)
+        get_guest_store().drop(guest_id)
         st.session_state.mode = None
-        st.session_state.chat_history = []
+        st.session_state.pop("guest_chat_id", None)
+        st.session_state.pop(f"_chat_window_{guest_id}", None)
         st.rerun()
     st.markdown("<div style='height:15vh'></div>", unsafe_allow_html=True)
     st.stop()
 
 # ========== LOGIN/AUTH/FIRESTORE MODE ==========
 if st.session_state.mode == "login":
+    import hashlib
+    from google.cloud import firestore
+    import chat_store
+    from firestore_db import FirestoreResource
+
+    GOOGLE_CLIENT_ID = st.secrets["GOOGLE_CLIENT_ID"]
+    GOOGLE_CLIENT_SECRET = st.secrets["GOOGLE_CLIENT_SECRET"]
+    MS_CLIENT_ID = st.secrets["MS_CLIENT_ID"]
+    MS_CLIENT_SECRET = st.secrets["MS_CLIENT_SECRET"]
 
-    # helpers (scoped to login mode)
-    def get_db():
-        if not hasattr(st.session_state, "firestore_db"):
-            svc = json.loads(st.secrets["FIREBASE_SERVICE_ACCOUNT"])
-            st.session_state.firestore_db = firestore.Client.from_service_account_info(svc)
-        return st.session_state.firestore_db
+    # start connecting to Firestore as soon as the first login-mode run happens
+    if "FIREBASE_SERVICE_ACCOUNT" in st.secrets:
+        get_db_resource()
 
     # initialize flags (once)
     if "logged_in" not in st.session_state:
@@ -293,11 +585,31 @@ if st.session_state.mode == "login":
         st.session_state.chat_history = []
     if "chat_title" not in st.session_state:
         st.session_state.chat_title = ""
+    if "chat_titles" not in st.session_state:
+        st.session_state.chat_titles = set()  # chats whose title was already requested
+    if "chat_dirty" not in st.session_state:
+        st.session_state.chat_dirty = False
+    if "saved_count" not in st.session_state:
+        st.session_state.saved_count = 0
+    if "chat_base" not in st.session_state:
+        st.session_state.chat_base = 0
+    if "chat_list_pages" not in st.session_state:
+        st.session_state.chat_list_pages = 1
     if "just_logged_in" not in st.session_state:
         st.session_state.just_logged_in = False
 
+    # st.context.cookies is fixed for the whole browser session, so only try it once
+    if not st.session_state.logged_in and not st.session_state.get("cookie_checked"):
+        st.session_state.cookie_checked = True
+        from_cookie = st.session_state.pop("cookie_entry", False)
+        if not resume_session() and from_cookie:
+            st.session_state.mode = None  # stale or forged cookie: back to the landing page
+            st.rerun()
+
     # -------- NOT LOGGED IN: show auth only (no app UI) --------
     if not st.session_state.logged_in:
+        if st.session_state.pop("cookie_clear", False):
+            write_cookie("", 0)
         config = load_config()
         menu = st.radio("Choose action", ["Login", "Sign Up"], key="auth_menu")
 
@@ -338,6 +650,8 @@ if st.session_state.mode == "login":
                     st.session_state.logged_in = True
                     st.session_state.user_id   = user_data.get("username") or login_username
                     st.session_state.just_logged_in = display_name
+                    get_profile_cache().put(st.session_state.user_id, user_data)
+                    st.session_state.session_claims = get_session_signer().new_claims(st.session_state.user_id)
                     # clean inputs
                     for k in ("li_user", "li_pass"):
                         st.session_state.pop(k, None)
@@ -367,112 +681,86 @@ if st.session_state.mode == "login":
         st.title("🤖 Gemini Chatbot")
 
         if st.button("🗑️ Clear Conversation", type="primary"):
+            discard_generation()
+            if st.session_state.chat_history:
+                st.session_state.chat_dirty = True
+            chat_context.reset_summary(st.session_state.chat_id)
             st.session_state.chat_history = []
+            st.session_state.chat_base = 0
 
         with st.form(key="chat_form", clear_on_submit=True):
             user_input = st.text_input("Type your message...", key="input_field")
             submitted = st.form_submit_button("Send")
 
-        # render chat bubbles
-        for chat in st.session_state.chat_history:
-            if chat["role"] == "user":
-                st.markdown(
-                    f"""
-                    <div style="display:flex; justify-content:flex-end; align-items:flex-end; margin:12px 0;">
-                        <div style="background:#0078fe; color:white; padding:12px 18px; border-radius:16px 16px 2px 16px; margin-left:8px; max-width:70%; box-shadow:1px 2px 4px rgba(0,0,0,0.04); font-size:1.1em; word-break:break-word;">
-                            {chat['text']}
-                        </div>
-                        <div style="margin-left:6px; font-size:1.6em;">🧑</div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
-            else:
-                st.markdown(
-                    f"""
-                    <div style="display:flex; justify-content:flex-start; align-items:flex-end; margin:12px 0;">
-                        <div style="margin-right:6px; font-size:1.6em;">🤖</div>
-                        <div style="background:#f1f0f0; color:#222; padding:12px 18px; border-radius:16px 16px 16px 2px; margin-right:8px; max-width:70%; box-shadow:1px 2px 4px rgba(0,0,0,0.04); font-size:1.1em; word-break:break-word;">
-                            {chat['text']}
-                        </div>
-                    </div>
-                    """,
-                    unsafe_allow_html=True,
-                )
+        ticket = admit_turn(f"user:{user_id}") if submitted and user_input else None
+        if ticket:
+            finish_generation(stopped=True)  # a new message replaces the answer in progress
+            # not marked dirty yet: the question is saved together with its answer
+            st.session_state.chat_history.append({"role": "user", "text": user_input})
+            start_generation(st.session_state.chat_id, st.session_state.chat_history,
+                             st.session_state.chat_base, ticket)
+        collect_generation()
+
+        # render chat bubbles (only the most recent window; older ones on demand)
+        chat_render.render_history(
+            st.session_state.chat_history,
+            st.session_state.chat_id,
+            load_older=(lambda: load_older_messages(user_id)) if st.session_state.chat_base > 0 else None,
+        )
+        if "generation" in st.session_state:
+            generation_panel()
         # SIDEBAR (only sidebar items here)
         with st.sidebar:
             st.subheader(f"Signed in as **{user_id}**")
             if st.button("➕ New Chat"):
-                st.session_state.chat_history = []
-                st.session_state.chat_title = ""
-                st.session_state.chat_id = str(uuid.uuid4())
+                start_chat()
                 st.rerun()
+            if is_admin(user_id):
+                render_metrics_panel()
             if st.button("🚪 Logout"):
-                for k in ["logged_in", "user_id", "chat_id", "chat_history", "chat_title"]:
+                discard_generation()
+                get_write_queue().flush()
+                revoke_sessions(user_id)
+                st.session_state.cookie_clear = True
+                for k in ["logged_in", "user_id", "chat_id", "chat_history", "chat_title", "chat_titles",
+                          "chat_dirty", "saved_count", "chat_base", "chat_list_pages", "chat_search_query",
+                          "chat_search_flushed", "session_claims", "cookie_chat"]:
                     st.session_state.pop(k, None)
                 st.rerun()
 
-        if submitted and user_input:
-            user_placeholder = st.empty()
-            partial_user_text = ""
-            for char in user_input:
-                partial_user_text += char
-                user_placeholder.markdown(
-                                f"""
-                                <div style='display:flex; justify-content:flex-end; align-items:flex-end; margin:10px 0;'>
-                                    <div style='background:#0078fe; color:white; padding:12px 18px; border-radius:16px 16px 2px 16px; max-width:60%; min-height:38px; word-break:break-word;'>
-                                        {partial_user_text}<span style="color:#eee;">▌</span>
-                                    </div>
-                                    <div style='margin-left:8px;font-size:1.5em;'>🧑</div>
-                                </div>
-                                """,
-                                unsafe_allow_html=True
-                            )
-                time.sleep(0.012)
-            user_placeholder.markdown(
-                            f"""
-                            <div style='display:flex; justify-content:flex-end; align-items:flex-end; margin:10px 0;'>
-                                <div style='background:#0078fe; color:white; padding:12px 18px; border-radius:16px 16px 2px 16px; max-width:60%; min-height:38px; word-break:break-word;'>
-                                    {user_input}
-                                </div>
-                                <div style='margin-left:8px;font-size:1.5em;'>🧑</div>
-                            """,
-                            unsafe_allow_html=True
-                        )
-
-            st.session_state.chat_history.append({"role": "user", "text": user_input})
+            query = st.text_input("🔍 Search chats", key="chat_search_query")
+            if query:
+                # include turns that are still queued, but only when the query changes: a
+                # flush can wait on Firestore, and this runs on every rerun while the box has text
+                if query != st.session_state.get("chat_search_flushed") and get_write_queue().pending():
+                    get_write_queue().flush()
+                st.session_state.chat_search_flushed = query
+                hits = chat_store.search_chats(db, user_id, query)
+                if not hits:
+                    st.caption("No matching chats.")
+                for hit in hits:
+                    if st.button(hit['title'], key=f"hit_{hit['chat_id']}"):
+                        open_chat(user_id, {'id': hit['chat_id'], 'title': hit['title']})
+                        st.rerun()
+                    if hit['snippet']:
+                        st.caption(hit['snippet'])
+
+            st.markdown("**Your chats**")
+            cursor = None
+            for _ in range(st.session_state.chat_list_pages):
+                chats, cursor = chat_store.list_user_chats(db, user_id, cursor=cursor)
+                for chat in chats:
+                    if st.button(chat['title'], key=f"open_{chat['id']}"):
+                        open_chat(user_id, chat)
+                        st.rerun()
+                if cursor is None:
+                    break
+            if cursor is not None and st.button("More chats"):
+                st.session_state.chat_list_pages += 1
+                st.rerun()
 
-            bot_placeholder = st.empty()
-            with st.spinner("Gemini is thinking..."):
-                bot_response = get_gemini_response(user_input)
-                partial_bot_text = ""
-                for char in bot_response:
-                    partial_bot_text += char
-                    bot_placeholder.markdown(
-                                    f"""
-                                    <div style='display:flex; justify-content:flex-start; align-items:flex-end; margin:10px 0;'>
-                                        <div style='margin-right:8px;font-size:1.5em;'>🤖</div>
-                                        <div style='background:#f1f0f0; color:#222; padding:12px 18px; border-radius:16px 16px 16px 2px; max-width:60%; min-height:38px; word-break:break-word;'>
-                                            {partial_bot_text}<span style="color:#888;">▌</span>
-                                    """,
-                                    unsafe_allow_html=True
-                                )
-                    time.sleep(0.012)
-                bot_placeholder.markdown(
-                                f"""
-                                <div style='display:flex; justify-content:flex-start; align-items:flex-end; margin:10px 0;'>
-                                    <div style='margin-right:8px;font-size:1.5em;'>🤖</div>
-                                    <div style='background:#f1f0f0; color:#222; padding:12px 18px; border-radius:16px 16px 16px 2px; max-width:60%; min-height:38px; word-break:break-word;'>
-                                        {bot_response}
-                                """,
-                                unsafe_allow_html=True
-                            )
-        save_chat(
-            user_id,
-            st.session_state.chat_id,
-            get_gemini_title(st.session_state.chat_history[:2]),
-            st.session_state.chat_history,
-        )
+        persist_chat(user_id)
+        sync_session_cookie(user_id)
 
 
 st.markdown("<div style='height:15vh'></div>", unsafe_allow_html=True)
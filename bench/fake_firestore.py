@@ -0,0 +1,369 @@
+"""In-memory stand-in for the subset of google.cloud.firestore.Client the app uses.
+
+Documents live in a dict keyed by path tuple. Reads and writes are counted the way
+Firestore bills them: one read per document returned (one for an empty query), one
+write per document written or deleted, batched or not. Sentinels from the real
+library (SERVER_TIMESTAMP, DELETE_FIELD, Increment, ArrayUnion, ArrayRemove) are
+understood, so chat_store runs against it unchanged.
+
+    db = FakeFirestore()
+    firestore.Client.from_service_account_info = lambda info: db
+"""
+import copy
+import datetime
+import threading
+import uuid
+
+from google.cloud import firestore
+from google.cloud.firestore_v1 import transforms
+
+
+class _Deleted:
+    pass
+
+
+_DELETED = _Deleted()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.docs = {}
+        self.reads = 0
+        self.writes = 0
+        self.lock = threading.RLock()
+        self._clock = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    # ---- client API ----
+    def collection(self, name):
+        return CollectionRef(self, (name,))
+
+    def document(self, path):
+        return DocumentRef(self, tuple(path.split("/")))
+
+    def collection_group(self, collection_id):
+        return Query(self, None, group=collection_id)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def transaction(self):
+        return Transaction(self)
+
+    def close(self):
+        pass
+
+    # ---- bookkeeping ----
+    def counters(self):
+        with self.lock:
+            return {"reads": self.reads, "writes": self.writes}
+
+    def now(self):
+        with self.lock:
+            self._clock += datetime.timedelta(milliseconds=1)
+            return self._clock
+
+    def _resolve(self, value, old):
+        if value is firestore.SERVER_TIMESTAMP:
+            return self.now()
+        if value is firestore.DELETE_FIELD:
+            return _DELETED
+        if isinstance(value, transforms.Increment):
+            return (old or 0) + value.value
+        if isinstance(value, transforms.ArrayUnion):
+            current = list(old or [])
+            return current + [v for v in value.values if v not in current]
+        if isinstance(value, transforms.ArrayRemove):
+            return [v for v in (old or []) if v not in value.values]
+        if isinstance(value, dict):
+            out = {}
+            for k, v in value.items():
+                r = self._resolve(v, old.get(k) if isinstance(old, dict) else None)
+                if r is not _DELETED:
+                    out[k] = r
+            return out
+        return copy.deepcopy(value)
+
+    def _merge(self, current, data):
+        out = dict(current)
+        for key, value in data.items():
+            if isinstance(value, dict) and isinstance(out.get(key), dict):
+                out[key] = self._merge(out[key], value)
+                continue
+            resolved = self._resolve(value, out.get(key))
+            if resolved is _DELETED:
+                out.pop(key, None)
+            else:
+                out[key] = resolved
+        return out
+
+    def _write(self, path, data, merge=False):
+        with self.lock:
+            self.writes += 1
+            if merge and path in self.docs:
+                self.docs[path] = self._merge(self.docs[path], data)
+            elif merge:
+                self.docs[path] = self._merge({}, data)
+            else:
+                self.docs[path] = self._resolve(data, None)
+
+    def _update(self, path, data):
+        # update() takes dotted field paths
+        nested = {}
+        for dotted, value in data.items():
+            parts = dotted.split(".")
+            node = nested
+            for p in parts[:-1]:
+                node = node.setdefault(p, {})
+            node[parts[-1]] = value
+        with self.lock:
+            if path not in self.docs:
+                raise KeyError(f"No document to update: {'/'.join(path)}")
+            self._write(path, nested, merge=True)
+
+    def _delete(self, path):
+        with self.lock:
+            self.writes += 1
+            self.docs.pop(path, None)
+
+
+def _split(field):
+    # "terms.`3d`" -> ["terms", "3d"]; quoting is only needed by the real client
+    return [part.strip("`") for part in field.split(".")]
+
+
+def _project(data, fields):
+    out = {}
+    for field in fields:
+        parts = _split(field)
+        value = data
+        for part in parts:
+            if not isinstance(value, dict) or part not in value:
+                break
+            value = value[part]
+        else:
+            node = out
+            for part in parts[:-1]:
+                node = node.setdefault(part, {})
+            node[parts[-1]] = value
+    return out
+
+
+class DocumentSnapshot:
+    def __init__(self, ref, data, fields=None):
+        self.reference = ref
+        self.id = ref.id
+        self.exists = data is not None
+        if data is not None and fields is not None:
+            data = _project(data, fields)
+        self._data = data
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field):
+        value = self._data
+        for part in _split(field):
+            value = value[part]
+        return copy.deepcopy(value)
+
+
+class DocumentRef:
+    def __init__(self, db, path):
+        self._db = db
+        self.path_tuple = path
+        self.id = path[-1]
+
+    @property
+    def path(self):
+        return "/".join(self.path_tuple)
+
+    @property
+    def parent(self):
+        return CollectionRef(self._db, self.path_tuple[:-1])
+
+    def collection(self, name):
+        return CollectionRef(self._db, self.path_tuple + (name,))
+
+    def get(self, field_paths=None, transaction=None):
+        with self._db.lock:
+            self._db.reads += 1
+            return DocumentSnapshot(self, copy.deepcopy(self._db.docs.get(self.path_tuple)), field_paths)
+
+    def set(self, data, merge=False):
+        self._db._write(self.path_tuple, data, merge)
+
+    def update(self, data):
+        self._db._update(self.path_tuple, data)
+
+    def delete(self):
+        self._db._delete(self.path_tuple)
+
+
+class Query:
+    _OPS = {
+        "<": lambda a, b: a < b,
+        "<=": lambda a, b: a <= b,
+        "==": lambda a, b: a == b,
+        "!=": lambda a, b: a != b,
+        ">": lambda a, b: a > b,
+        ">=": lambda a, b: a >= b,
+        "in": lambda a, b: a in b,
+        "array_contains": lambda a, b: b in a,
+    }
+
+    def __init__(self, db, path, group=None, orders=(), filters=(), limit=None, after=None, fields=None):
+        self._db = db
+        self._path = path
+        self._group = group
+        self._orders = orders
+        self._filters = filters
+        self._limit = limit
+        self._after = after
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = dict(group=self._group, orders=self._orders, filters=self._filters,
+                     limit=self._limit, after=self._after, fields=self._fields)
+        state.update(changes)
+        return Query(self._db, self._path, **state)
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def where(self, field=None, op=None, value=None, filter=None):
+        if filter is not None:
+            field, op, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def select(self, fields):
+        return self._copy(fields=set(fields))
+
+    def start_after(self, values):
+        return self._copy(after=values)
+
+    def _matches_path(self, path):
+        if self._group is not None:
+            return len(path) % 2 == 0 and path[-2] == self._group
+        return len(path) == len(self._path) + 1 and path[:-1] == self._path
+
+    @staticmethod
+    def _field(path, data, field):
+        if field == "__name__":
+            return "/".join(path)
+        value = data
+        for part in _split(field):
+            if not isinstance(value, dict) or part not in value:
+                return None
+            value = value[part]
+        return value
+
+    def _sort_key(self, path, data):
+        return tuple(self._field(path, data, f) for f, _ in self._orders)
+
+    def stream(self):
+        with self._db.lock:
+            rows = [(p, d) for p, d in self._db.docs.items() if self._matches_path(p)]
+            # like Firestore, ordering by a field skips documents that don't have it
+            for field, _ in self._orders:
+                rows = [(p, d) for p, d in rows if self._field(p, d, field) is not None]
+            for field, op, value in self._filters:
+                rows = [(p, d) for p, d in rows
+                        if self._field(p, d, field) is not None and self._OPS[op](self._field(p, d, field), value)]
+            rows.sort(key=lambda r: r[0])
+            for field, direction in reversed(self._orders):
+                rows.sort(key=lambda r: (self._field(r[0], r[1], field) is None, self._field(r[0], r[1], field)),
+                          reverse=(direction == "DESCENDING"))
+            if self._after is not None and self._orders:
+                if isinstance(self._after, DocumentSnapshot):
+                    cursor = self._sort_key(self._after.reference.path_tuple, self._after._data or {})
+                else:
+                    cursor = tuple(self._after.get(f) for f, _ in self._orders)
+                    cursor = tuple(v.path if isinstance(v, DocumentRef) else v for v in cursor)
+                descending = self._orders[0][1] == "DESCENDING"
+                rows = [r for r in rows
+                        if (self._sort_key(*r) < cursor if descending else self._sort_key(*r) > cursor)]
+            if self._limit is not None:
+                rows = rows[:self._limit]
+            self._db.reads += max(len(rows), 1)
+            snaps = [DocumentSnapshot(DocumentRef(self._db, p), copy.deepcopy(d), self._fields) for p, d in rows]
+        return iter(snaps)
+
+    def get(self):
+        return list(self.stream())
+
+
+class CollectionRef(Query):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path[-1]
+
+    def document(self, doc_id=None):
+        return DocumentRef(self._db, self._path + (doc_id or uuid.uuid4().hex,))
+
+    def list_documents(self):
+        with self._db.lock:
+            paths = [p for p in self._db.docs if self._matches_path(p)]
+            self._db.reads += max(len(paths), 1)
+        return [DocumentRef(self._db, p) for p in paths]
+
+
+class WriteBatch:
+    def __init__(self, db):
+        self._db = db
+        self._ops = []
+
+    def set(self, ref, data, merge=False):
+        self._ops.append(lambda: ref.set(data, merge=merge))
+
+    def update(self, ref, data):
+        self._ops.append(lambda: ref.update(data))
+
+    def delete(self, ref):
+        self._ops.append(ref.delete)
+
+    def commit(self):
+        with self._db.lock:
+            for op in self._ops:
+                op()
+        self._ops = []
+
+
+class Transaction(WriteBatch):
+    """Enough of firestore.Transaction for @firestore.transactional.
+
+    The database lock is held from begin to commit, so transactions are serialized
+    rather than retried; reads inside one go through DocumentRef.get as usual.
+    """
+
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, db):
+        super().__init__(db)
+        self._id = None
+
+    def _clean_up(self):
+        self._ops = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._db.lock.acquire()
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        try:
+            with self._db.lock:
+                for op in self._ops:
+                    op()
+        finally:
+            self._clean_up()
+            self._db.lock.release()
+        return []
+
+    def _rollback(self):
+        if self._id is not None:
+            self._clean_up()
+            self._db.lock.release()
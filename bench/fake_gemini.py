@@ -0,0 +1,129 @@
+"""Local stand-in for the Gemini REST API.
+
+Serves ``models/{model}:generateContent`` and ``models/{model}:streamGenerateContent``
+(SSE when ``alt=sse``) with a configurable time-to-first-token and token rate, and
+counts requests so a benchmark can report API calls per turn.
+
+    python -m bench.fake_gemini --port 8765 --latency-ms 300 --tokens-per-sec 80
+    GEMINI_API_BASE=http://127.0.0.1:8765/v1beta/models streamlit run app.py
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LOREM = (
+    "Sure, here is a thorough answer that goes over the main points step by step, "
+    "with a short example at the end so you can try it out yourself right away."
+).split()
+
+
+class FakeGemini:
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=300, tokens_per_sec=80,
+                 reply_words=60, chunk_words=4):
+        self.latency = latency_ms / 1000
+        self.token_interval = 1 / tokens_per_sec if tokens_per_sec else 0
+        self.reply_words = reply_words
+        self.chunk_words = chunk_words
+        self.counts = {"generate": 0, "stream": 0, "bytes_in": 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1beta/models"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reply_for(self, body):
+        try:
+            prompt = body["contents"][-1]["parts"][0]["text"]
+        except (KeyError, IndexError, TypeError):
+            prompt = ""
+        words = [f"({len(prompt)} chars)"] + [LOREM[i % len(LOREM)] for i in range(self.reply_words - 1)]
+        return words
+
+    def _count(self, key, size):
+        with self._lock:
+            self.counts[key] += 1
+            self.counts["bytes_in"] += size
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                size = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(size) or b"{}")
+                words = fake.reply_for(body)
+                time.sleep(fake.latency)
+                if ":streamGenerateContent" in self.path:
+                    fake._count("stream", size)
+                    self._stream(words)
+                else:
+                    fake._count("generate", size)
+                    time.sleep(fake.token_interval * len(words))
+                    self._json(" ".join(words))
+
+            def _json(self, text):
+                payload = json.dumps({"candidates": [{"content": {"parts": [{"text": text}]}}]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _stream(self, words):
+                self.send_response(200)
+                # chunked like the real API, one SSE event per HTTP chunk
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                step = fake.chunk_words
+                try:
+                    for i in range(0, len(words), step):
+                        chunk = " ".join(words[i:i + step]) + " "
+                        event = {"candidates": [{"content": {"parts": [{"text": chunk}]}}]}
+                        data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+                        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                        self.wfile.flush()
+                        time.sleep(fake.token_interval * step)
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # client hung up (cancelled)
+                self.close_connection = True
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-sec", type=float, default=80)
+    parser.add_argument("--reply-words", type=int, default=60)
+    args = parser.parse_args()
+    fake = FakeGemini(port=args.port, latency_ms=args.latency_ms,
+                      tokens_per_sec=args.tokens_per_sec, reply_words=args.reply_words)
+    print(f"fake Gemini listening on {fake.base_url}")
+    fake.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
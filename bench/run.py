@@ -0,0 +1,253 @@
+"""Offline end-to-end benchmark for the chat hot paths.
+
+Runs scripted guest and login sessions through streamlit's AppTest against a local
+fake Gemini server (bench.fake_gemini) and an in-memory Firestore (bench.fake_firestore),
+then times the storage helpers on their own. Nothing talks to Google.
+
+    python -m bench.run
+    python -m bench.run --turns 20 --latency-ms 500 --tokens-per-sec 40 --json
+
+Reported per flow:
+  ttfb        submit -> first streamed chunk reaching the app
+  turn        submit -> answer finished and moved into the history
+  reruns/msg  script runs per message sent
+  fs r/w      Firestore reads/writes per turn (write-behind queue flushed)
+  api calls   Gemini requests per turn (stream + generate, e.g. titles)
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_PATH = os.path.join(ROOT, "app.py")
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from bench.fake_firestore import FakeFirestore  # noqa: E402
+from bench.fake_gemini import FakeGemini  # noqa: E402
+
+
+class Probe:
+    """Hooks into the app's modules to observe one turn at a time."""
+
+    def __init__(self, db):
+        import chat_render
+        import chat_store
+        import gemini_client
+        from google.cloud import firestore
+
+        self.db = db
+        self.turn_started = None
+        self.first_chunk = None
+        self.runs = 0
+        self.queues = []
+
+        firestore.Client.from_service_account_info = staticmethod(lambda info: db)
+
+        probe = self
+        original_stream = gemini_client.GeminiClient.stream
+
+        def stream(client, contents, cancel=None):
+            for chunk in original_stream(client, contents, cancel=cancel):
+                if probe.first_chunk is None:
+                    probe.first_chunk = time.perf_counter()
+                yield chunk
+        gemini_client.GeminiClient.stream = stream
+
+        original_render = chat_render.render_history
+
+        def render_history(*args, **kwargs):
+            probe.runs += 1
+            return original_render(*args, **kwargs)
+        chat_render.render_history = render_history
+
+        original_queue = chat_store.WriteBehindQueue
+
+        class RecordingQueue(original_queue):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                probe.queues.append(self)
+        chat_store.WriteBehindQueue = RecordingQueue
+
+    def flush(self):
+        for q in self.queues:
+            q.flush()
+
+    def start_turn(self):
+        self.flush()
+        self.turn_started = time.perf_counter()
+        self.first_chunk = None
+        self.runs = 0
+
+
+def new_app():
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    for key in ("GOOGLE_CLIENT_ID", "GOOGLE_CLIENT_SECRET", "MS_CLIENT_ID", "MS_CLIENT_SECRET"):
+        at.secrets[key] = "bench"
+    at.secrets["FIREBASE_SERVICE_ACCOUNT"] = "{}"
+    return at
+
+
+def button(at, label):
+    for b in at.button:
+        if label in b.label:
+            return b
+    raise LookupError(f"no button {label!r}; have {[b.label for b in at.button]}")
+
+
+def check(at):
+    if at.exception:
+        raise RuntimeError("; ".join(str(e.value) for e in at.exception))
+
+
+def send_turns(at, probe, fake, input_key, turns, label):
+    samples = []
+    for i in range(turns):
+        before_api = dict(fake.counts)
+        before_fs = probe.db.counters()
+        at.text_input(key=input_key).input(f"{label} question {i}: how does this work?")
+        probe.start_turn()
+        button(at, "Send").click().run()
+        check(at)
+        # the answer streams on a worker thread; the next run moves it into the history
+        if "generation" in at.session_state:
+            at.session_state["generation"].join(60)
+            at.run()
+        ended = time.perf_counter()
+        check(at)
+        probe.flush()
+        after_fs = probe.db.counters()
+        samples.append({
+            "ttfb_ms": ((probe.first_chunk or ended) - probe.turn_started) * 1000,
+            "turn_ms": (ended - probe.turn_started) * 1000,
+            "runs": probe.runs,
+            "reads": after_fs["reads"] - before_fs["reads"],
+            "writes": after_fs["writes"] - before_fs["writes"],
+            "api_calls": (fake.counts["stream"] + fake.counts["generate"]
+                          - before_api["stream"] - before_api["generate"]),
+        })
+    return samples
+
+
+def run_guest(probe, fake, turns):
+    at = new_app()
+    at.run()
+    button(at, "Guest").click().run()
+    check(at)
+    return send_turns(at, probe, fake, "input_field_guest", turns, "guest")
+
+
+def run_login(probe, fake, turns):
+    at = new_app()
+    at.run()
+    button(at, "Sign in").click().run()
+    at.radio(key="auth_menu").set_value("Sign Up").run()
+    at.text_input(key="su_user").input("bench")
+    at.text_input(key="su_pass").input("bench-password")
+    button(at, "Sign Up").click().run()
+    at.radio(key="auth_menu").set_value("Login").run()
+    at.text_input(key="li_user").input("bench")
+    at.text_input(key="li_pass").input("bench-password")
+    button(at, "Login").click().run()
+    check(at)
+    return send_turns(at, probe, fake, "input_field", turns, "login")
+
+
+def bench_storage(turns):
+    # The storage helpers on their own: one appended turn and one sidebar page
+    import chat_store
+
+    db = FakeFirestore()
+    user = "storage-bench"
+    for c in range(25):
+        chat_store.save_chat(db, user, f"chat-{c}", f"Chat {c}", [
+            {"role": "user", "text": "question"}, {"role": "gemini", "text": "answer"},
+        ] * turns)
+
+    def cost(fn):
+        before = db.counters()
+        start = time.perf_counter()
+        fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        after = db.counters()
+        return {"reads": after["reads"] - before["reads"], "writes": after["writes"] - before["writes"],
+                "ms": elapsed}
+
+    turn = [{"role": "user", "text": "one more"}, {"role": "gemini", "text": "sure"}]
+    chat_store.invalidate_chat_list(user)
+    return {
+        "save_chat (1 turn)": cost(lambda: chat_store.save_chat(db, user, "chat-0", "Chat 0", turn)),
+        "list_user_chats (cold page)": cost(lambda: chat_store.list_user_chats(db, user)),
+        "list_user_chats (cached page)": cost(lambda: chat_store.list_user_chats(db, user)),
+        "load_chat_messages (newest page)": cost(lambda: chat_store.load_chat_messages(db, user, "chat-0")),
+    }
+
+
+def pct(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    return {
+        "turns": len(samples),
+        "ttfb_p50_ms": statistics.median(s["ttfb_ms"] for s in samples),
+        "ttfb_p95_ms": pct([s["ttfb_ms"] for s in samples], 95),
+        "turn_p50_ms": statistics.median(s["turn_ms"] for s in samples),
+        "turn_p95_ms": pct([s["turn_ms"] for s in samples], 95),
+        "reruns_per_msg": statistics.mean(s["runs"] for s in samples),
+        "fs_reads_per_turn": statistics.mean(s["reads"] for s in samples),
+        "fs_writes_per_turn": statistics.mean(s["writes"] for s in samples),
+        "api_calls_per_turn": statistics.mean(s["api_calls"] for s in samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--tokens-per-sec", type=float, default=80)
+    parser.add_argument("--reply-words", type=int, default=60)
+    parser.add_argument("--flows", nargs="+", choices=["guest", "login", "storage"],
+                        default=["guest", "login", "storage"])
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    fake = FakeGemini(latency_ms=args.latency_ms, tokens_per_sec=args.tokens_per_sec,
+                      reply_words=args.reply_words).start()
+    os.environ["GEMINI_API_BASE"] = fake.base_url
+    os.environ.setdefault("GEMINI_API_KEY", "bench")
+    os.environ.setdefault("GEMINI_USER_RATE", "1000")  # measure the app, not the rate limiter
+    probe = Probe(FakeFirestore())
+
+    report = {}
+    if "guest" in args.flows:
+        report["guest"] = summarize(run_guest(probe, fake, args.turns))
+    if "login" in args.flows:
+        report["login"] = summarize(run_login(probe, fake, args.turns))
+    if "storage" in args.flows:
+        report["storage"] = bench_storage(args.turns)
+    fake.stop()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for flow in ("guest", "login"):
+        if flow in report:
+            r = report[flow]
+            print(f"{flow:<6} ttfb p50/p95 {r['ttfb_p50_ms']:6.0f}/{r['ttfb_p95_ms']:<6.0f} ms  "
+                  f"turn p50/p95 {r['turn_p50_ms']:6.0f}/{r['turn_p95_ms']:<6.0f} ms  "
+                  f"reruns/msg {r['reruns_per_msg']:.1f}  fs r/w per turn "
+                  f"{r['fs_reads_per_turn']:.1f}/{r['fs_writes_per_turn']:.1f}  "
+                  f"api calls/turn {r['api_calls_per_turn']:.1f}")
+    for name, r in report.get("storage", {}).items():
+        print(f"{name:<34} reads {r['reads']:>4}  writes {r['writes']:>4}  {r['ms']:7.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""Cold-start cost of app.py per mode.
+
+Each mode is measured in a fresh interpreter: streamlit is imported first (that
+cost is shared by every mode and reported separately), then the script's first
+run is timed through streamlit's AppTest and the RSS growth is recorded.
+
+    python -m bench.startup            # table
+    python -m bench.startup --json     # machine-readable
+    python -m bench.startup --check    # exit 1 if a budget is exceeded
+
+Guest and landing runs must not import the Firestore/auth stack at all.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+MODES = ["landing", "guest", "login"]
+HEAVY_MODULES = ["google.cloud.firestore", "firebase_admin", "grpc", "yaml"]
+
+# (first-run ms, RSS growth MB) per mode, on top of the streamlit import itself
+BUDGETS = {
+    "landing": (800, 25),
+    "guest": (800, 25),
+    "login": (2000, 80),
+}
+
+CHILD = r"""
+import json, os, resource, sys, time
+
+def rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+t0 = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+streamlit_ms = (time.perf_counter() - t0) * 1000
+rss_before = rss_mb()
+
+app_path, mode, heavy = sys.argv[1], sys.argv[2], sys.argv[3].split(",")
+at = AppTest.from_file(app_path, default_timeout=120)
+for key in ("GOOGLE_CLIENT_ID", "GOOGLE_CLIENT_SECRET", "MS_CLIENT_ID", "MS_CLIENT_SECRET"):
+    at.secrets[key] = "bench"
+if mode != "landing":
+    at.session_state["mode"] = mode
+t1 = time.perf_counter()
+at.run()
+run_ms = (time.perf_counter() - t1) * 1000
+print(json.dumps({
+    "streamlit_ms": streamlit_ms,
+    "run_ms": run_ms,
+    "rss_mb": rss_mb() - rss_before,
+    "errors": [str(e.value) for e in at.exception],
+    "heavy": [m for m in heavy if m in sys.modules],
+}))
+"""
+
+
+def measure(mode, repeat):
+    samples = []
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", CHILD, APP_PATH, mode, ",".join(HEAVY_MODULES)],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(APP_PATH),
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {
+        "mode": mode,
+        "streamlit_ms": statistics.median(s["streamlit_ms"] for s in samples),
+        "run_ms": statistics.median(s["run_ms"] for s in samples),
+        "rss_mb": statistics.median(s["rss_mb"] for s in samples),
+        "errors": samples[-1]["errors"],
+        "heavy": samples[-1]["heavy"],
+    }
+
+
+def check(result):
+    problems = []
+    max_ms, max_mb = BUDGETS[result["mode"]]
+    if result["run_ms"] > max_ms:
+        problems.append(f"first run {result['run_ms']:.0f} ms > {max_ms} ms")
+    if result["rss_mb"] > max_mb:
+        problems.append(f"RSS +{result['rss_mb']:.1f} MB > {max_mb} MB")
+    if result["mode"] != "login" and result["heavy"]:
+        problems.append("imported " + ", ".join(result["heavy"]))
+    if result["errors"]:
+        problems.append("script raised: " + "; ".join(result["errors"]))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--repeat", type=int, default=3, help="fresh interpreters per mode (median is reported)")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 when a mode is over budget")
+    args = parser.parse_args()
+
+    results = [measure(mode, args.repeat) for mode in args.modes]
+    failed = False
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(f"{'mode':<8} {'first run':>10} {'RSS':>9} {'streamlit':>10}  heavy modules")
+    for r in results:
+        problems = check(r)
+        failed = failed or bool(problems)
+        if not args.json:
+            print(f"{r['mode']:<8} {r['run_ms']:>7.0f} ms {r['rss_mb']:>+6.1f} MB {r['streamlit_ms']:>7.0f} ms  "
+                  f"{', '.join(r['heavy']) or '-'}")
+            for p in problems:
+                print(f"  over budget: {p}")
+    if args.check and failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import threading
+from collections import OrderedDict
+
+# Rough budget for the whole `contents` array; Gemini counts ~4 chars per token for English
+CONTEXT_TOKEN_BUDGET = int(os.getenv("GEMINI_CONTEXT_TOKENS", "4000"))
+# When the verbatim window overflows, fold old turns until it fits in this share of the budget,
+# so a summary call happens every few turns instead of on every turn
+FOLD_TARGET = 0.6
+SUMMARY_CACHE_MAX = 2048
+
+# chat_id -> (upto_seq, summary); the summary covers every message with seq < upto_seq
+_summaries = OrderedDict()
+_summaries_lock = threading.Lock()
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+def gemini_role(role):
+    return "user" if role == "user" else "model"
+
+
+def title_prompt(messages):
+    # Title from the opening exchange; shared by the app and the export/backfill tool
+    chat_content = "\n".join(f"{m['role']}: {m['text']}" for m in messages[:2])
+    return "Summarize this conversation so far with a short, descriptive title (max 8 words):\n" + chat_content
+
+
+def clean_title(text):
+    return text.strip().replace('"', '')
+
+
+def get_summary(chat_id):
+    with _summaries_lock:
+        entry = _summaries.get(chat_id)
+        if entry:
+            _summaries.move_to_end(chat_id)
+        return entry or (0, "")
+
+
+def set_summary(chat_id, upto, summary):
+    with _summaries_lock:
+        _summaries[chat_id] = (upto, summary)
+        _summaries.move_to_end(chat_id)
+        while len(_summaries) > SUMMARY_CACHE_MAX:
+            _summaries.popitem(last=False)
+
+
+def reset_summary(chat_id):
+    with _summaries_lock:
+        _summaries.pop(chat_id, None)
+
+
+def build_contents(chat_id, history, base, summarize, budget=CONTEXT_TOKEN_BUDGET):
+    """Packs the conversation into a Gemini `contents` array that fits `budget`.
+
+    `history` is the loaded tail of the chat (its first message has seq `base`) and
+    ends with the message being answered. Turns that no longer fit are folded into
+    a rolling summary via `summarize(previous_summary, turns)`, which returns the new
+    summary or None on failure. The summary is cached per chat_id and only ever
+    extended with the newly folded turns.
+    """
+    end = base + len(history)
+    upto, summary = get_summary(chat_id)
+    if upto > end:
+        # chat was cleared or replaced since the summary was made
+        upto, summary = 0, ""
+    start = max(upto, base)
+    tokens = [estimate_tokens(m["text"]) for m in history]
+    window = sum(tokens[start - base:])
+
+    if estimate_tokens(summary) + window > budget:
+        target = budget * FOLD_TARGET - estimate_tokens(summary)
+        fold_to, folded_window = start, window
+        # always keep the message being answered verbatim
+        while fold_to < end - 1 and folded_window > target:
+            folded_window -= tokens[fold_to - base]
+            fold_to += 1
+        new_summary = summarize(summary, history[start - base:fold_to - base])
+        if new_summary:
+            summary = new_summary
+            set_summary(chat_id, fold_to, summary)
+            start, window = fold_to, folded_window
+        # if summarizing failed (or the summary itself grew large) just drop the oldest turns
+        while start < end - 1 and estimate_tokens(summary) + window > budget:
+            window -= tokens[start - base]
+            start += 1
+
+    contents = []
+    if summary:
+        contents.append({"role": "user", "parts": [{"text": "Summary of our conversation so far:\n" + summary}]})
+        contents.append({"role": "model", "parts": [{"text": "Got it, I'll keep that in mind."}]})
+    for m in history[start - base:]:
+        contents.append({"role": gemini_role(m["role"]), "parts": [{"text": m["text"]}]})
+    return contents
@@ -0,0 +1,67 @@
+
+import streamlit as st
+
+import metrics
+
+CHAT_WINDOW = 30  # bubbles rendered per rerun; older ones sit behind "Show earlier"
+STREAM_FRAME_INTERVAL = 0.1  # seconds between bubble repaints while an answer is generating
+
+# Styles live in one <style> block per run instead of being repeated inline in every bubble
+CHAT_CSS = """
+<style>
+.chat-row {display:flex; align-items:flex-end; margin:12px 0;}
+.chat-row.user {justify-content:flex-end;}
+.chat-row.bot {justify-content:flex-start;}
+.chat-bubble {padding:12px 18px; max-width:70%; min-height:38px; box-shadow:1px 2px 4px rgba(0,0,0,0.04); font-size:1.1em; word-break:break-word;}
+.chat-bubble.user {background:#0078fe; color:white; border-radius:16px 16px 2px 16px; margin-left:8px;}
+.chat-bubble.bot {background:#f1f0f0; color:#222; border-radius:16px 16px 16px 2px; margin-right:8px;}
+.chat-avatar {font-size:1.6em;}
+.chat-row.user .chat-avatar {margin-left:6px;}
+.chat-row.bot .chat-avatar {margin-right:6px;}
+.chat-cursor {color:#888;}
+</style>
+"""
+
+# Single-line templates: a blank line inside an HTML block would end it and leak markdown
+USER_BUBBLE = '<div class="chat-row user"><div class="chat-bubble user">{text}</div><div class="chat-avatar">🧑</div></div>'
+BOT_BUBBLE = '<div class="chat-row bot"><div class="chat-avatar">🤖</div><div class="chat-bubble bot">{text}{cursor}</div></div>'
+CURSOR = '<span class="chat-cursor">▌</span>'
+
+
+def inject_css():
+    st.markdown(CHAT_CSS, unsafe_allow_html=True)
+
+
+def bubble_html(role, text, cursor=False):
+    text = text.replace("\n", "<br>")
+    if role == "user":
+        return USER_BUBBLE.format(text=text)
+    return BOT_BUBBLE.format(text=text, cursor=CURSOR if cursor else "")
+
+
+@metrics.timed("render_history")
+def render_history(history, key, load_older=None):
+    """Renders the last CHAT_WINDOW messages of `history` as a single element.
+
+    The whole window is rebuilt and re-sent on every rerun; what keeps that cheap
+    is the fixed window size, not caching, so a long chat costs the same as a short one.
+    A "Show earlier" button widens the window; once everything loaded is shown,
+    `load_older` (if given) is offered to fetch more from storage.
+    """
+    inject_css()
+    window_key = f"_chat_window_{key}"
+    window = st.session_state.setdefault(window_key, CHAT_WINDOW)
+    hidden = len(history) - window
+    if hidden > 0:
+        if st.button(f"⬆️ Show earlier ({hidden})", key=f"show_earlier_{key}"):
+            st.session_state[window_key] += CHAT_WINDOW
+            st.rerun()
+    elif load_older is not None:
+        if st.button("⬆️ Load older messages", key=f"load_older_{key}"):
+            load_older()
+            st.session_state[window_key] += CHAT_WINDOW
+            st.rerun()
+    if history:
+        shown = history[max(hidden, 0):]
+        st.markdown("\n".join(bubble_html(m["role"], m["text"]) for m in shown), unsafe_allow_html=True)
+
@@ -0,0 +1,123 @@
+"""Full-text search over a user's saved chats.
+
+Each chat's postings live in companion documents users/{user_id}/search/{chat_id}~{shard},
+one per SHARD_MESSAGES messages:
+
+    chat:  the chat id
+    terms: {term: number of messages containing it}
+    last:  {term: seq of the newest message containing it}
+
+They are written with merges and Increment, so indexing a turn costs one write and no
+reads. Firestore's automatic single-field index on `terms.<term>` is the inverted index:
+a lookup is an ordered query that reads only the search docs of chats containing the
+term, never the chats. `last` is only ever projected, so firestore.indexes.json exempts
+it from indexing. Sharding keeps every search doc under Firestore's 40k index entries
+per document however long the chat gets.
+"""
+import math
+import re
+
+from google.cloud import firestore
+from google.cloud.firestore_v1 import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+# letters and digits only: an underscore could form a reserved `__name__`-style field
+TOKEN_RE = re.compile(r"[^\W_]+")
+MIN_TERM_LEN = 2
+MAX_TERM_LEN = 24
+# Firestore allows 40k index entries per document, and each term costs up to four
+# (asc + desc for terms.* and for last.*, if its exemption isn't deployed), so bound
+# what one shard can hold: SHARD_MESSAGES * MAX_TERMS_PER_MESSAGE * 4 = 32768
+MAX_TERMS_PER_MESSAGE = 64
+SHARD_MESSAGES = 128
+MAX_QUERY_TERMS = 5
+TERM_CANDIDATES = 25  # search docs read per query term
+SNIPPET_CHARS = 90
+STOPWORDS = frozenset("""
+    a an and are as at be but by can do does for from had has have how i if in is it its
+    me my no not of on or our so than that the their them then there these they this to
+    was we were what when where which who why will with would you your
+""".split())
+
+
+def tokenize(text):
+    return [t for t in TOKEN_RE.findall(text.lower())
+            if MIN_TERM_LEN <= len(t) <= MAX_TERM_LEN and t not in STOPWORDS]
+
+
+def search_collection(db, user_id):
+    return db.collection('users').document(user_id).collection('search')
+
+
+def shard_id(chat_id, seq):
+    return f"{chat_id}~{seq // SHARD_MESSAGES:04d}"
+
+
+def index_ops(db, user_id, chat_id, messages, first_seq=0):
+    # Write ops (chat_store's tuple format) adding `messages` to the chat's postings
+    shards = {}  # doc id -> (counts, last)
+    for i, m in enumerate(messages):
+        seq = first_seq + i
+        counts, last = shards.setdefault(shard_id(chat_id, seq), ({}, {}))
+        for term in list(dict.fromkeys(tokenize(m['text'])))[:MAX_TERMS_PER_MESSAGE]:
+            counts[term] = counts.get(term, 0) + 1
+            last[term] = seq
+    col = search_collection(db, user_id)
+    return [('merge', col.document(doc_id), {
+        'chat': chat_id,
+        'terms': {term: firestore.Increment(n) for term, n in counts.items()},
+        'last': last,
+    }) for doc_id, (counts, last) in shards.items() if counts]
+
+
+def unindex_ops(db, user_id, chat_id):
+    # Reads the chat's shard ids (one query); the doc named just {chat_id} is the pre-shard layout
+    col = search_collection(db, user_id)
+    shards = col.where(filter=FieldFilter('chat', '==', chat_id)).select([]).stream()
+    refs = {d.reference.path: d.reference for d in shards}
+    legacy = col.document(chat_id)
+    refs[legacy.path] = legacy
+    return [('delete', ref, None) for ref in refs.values()]
+
+
+def search(db, user_id, query, limit=10):
+    """Ranked [{chat_id, score, matched, seq}] for the chats containing the query terms.
+
+    Chats matching more of the terms come first, then by a tf-idf style score;
+    `seq` points at the newest message containing one of the terms.
+    """
+    terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+    col = search_collection(db, user_id)
+    scores, matched, newest = {}, {}, {}
+    for term in terms:
+        count_path = FieldPath('terms', term).to_api_repr()
+        last_path = FieldPath('last', term).to_api_repr()
+        docs = list(
+            col.order_by(count_path, direction=firestore.Query.DESCENDING)
+            .limit(TERM_CANDIDATES)
+            .select(['chat', count_path, last_path])
+            .stream()
+        )
+        # a chat's shards add up to one term frequency
+        tfs, lasts = {}, {}
+        for d in docs:
+            data = d.to_dict()
+            chat_id = data.get('chat') or d.id  # pre-shard docs are named after the chat
+            tfs[chat_id] = tfs.get(chat_id, 0) + max(data.get('terms', {}).get(term, 1), 1)
+            lasts[chat_id] = max(lasts.get(chat_id, -1), data.get('last', {}).get(term, -1))
+        weight = 1 / math.log(2 + len(tfs))  # terms found in fewer chats weigh more
+        for chat_id, tf in tfs.items():
+            scores[chat_id] = scores.get(chat_id, 0.0) + (1 + math.log(tf)) * weight
+            matched[chat_id] = matched.get(chat_id, 0) + 1
+            newest[chat_id] = max(newest.get(chat_id, -1), lasts[chat_id])
+    ranked = sorted(scores, key=lambda c: (matched[c], scores[c]), reverse=True)[:limit]
+    return [{'chat_id': c, 'score': scores[c], 'matched': matched[c], 'seq': newest[c]} for c in ranked]
+
+
+def snippet(text, query, width=SNIPPET_CHARS):
+    # A window of `text` around the first query term it contains
+    lowered = text.lower()
+    positions = [p for p in (lowered.find(t) for t in tokenize(query)) if p >= 0]
+    start = max(min(positions) - width // 3, 0) if positions else 0
+    out = text[start:start + width].replace("\n", " ")
+    return ("…" if start else "") + out + ("…" if start + width < len(text) else "")
@@ -0,0 +1,574 @@
+import atexit
+import logging
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from google.api_core import exceptions as gexc
+from google.cloud import firestore
+from google.cloud.firestore_v1.field_path import FieldPath
+
+import chat_search
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Layout:
+#   users/{user_id}/chats/{chat_id}                  -> title, created_at, updated_at, message_count
+#   users/{user_id}/chats/{chat_id}/messages/{seq}   -> seq, role, text, created_at
+#   users/{user_id}/search/{chat_id}~{shard}         -> per-chat postings (see chat_search)
+# Each turn only uploads its own message docs plus a small metadata update. Seqs are
+# reserved from message_count in a transaction, so sessions sharing a chat never collide.
+# Postings are
+# committed in a batch of their own, so a search-index failure never loses messages.
+
+BATCH_LIMIT = 500  # Firestore's max writes per batch
+CHAT_PAGE_SIZE = 20
+MESSAGE_PAGE_SIZE = 50
+CHAT_LIST_TTL = 30  # seconds a sidebar page may be served from memory
+CHAT_LIST_CACHE_MAX = 4096
+EXPORT_PAGE_SIZE = 200
+SEARCH_LIMIT = 8
+SEARCH_TTL = 30
+# Errors a retry can't fix: the write itself is bad (e.g. a reserved field name)
+PERMANENT_ERRORS = (
+    gexc.InvalidArgument, gexc.FailedPrecondition, gexc.PermissionDenied,
+    gexc.NotFound, gexc.AlreadyExists, gexc.OutOfRange, ValueError, TypeError,
+)
+
+# user_id -> {(cursor, page_size): (expires_at, (chats, next_cursor))}
+_chat_list_cache = {}
+_chat_list_lock = threading.Lock()
+# user_id -> {(query, limit): (expires_at, hits)}
+_search_cache = {}
+_search_lock = threading.Lock()
+
+
+def chats_collection(db, user_id):
+    return db.collection('users').document(user_id).collection('chats')
+
+
+def message_doc_id(seq):
+    # zero-padded so document ids sort in conversation order
+    return f"{seq:08d}"
+
+
+def _commit_in_batches(db, ops):
+    for i in range(0, len(ops), BATCH_LIMIT):
+        batch = db.batch()
+        for op, ref, data in ops[i:i + BATCH_LIMIT]:
+            if op == 'delete':
+                batch.delete(ref)
+            else:
+                batch.set(ref, data, merge=(op == 'merge'))
+        batch.commit()
+
+
+def _save_ops(db, user_id, chat_id, chat_title, messages, first_seq=0, created_at=firestore.SERVER_TIMESTAMP):
+    if not chat_title and messages and first_seq == 0:
+        chat_title = messages[0]["text"][:30]
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+    messages_ref = chat_ref.collection('messages')
+
+    ops = []
+    for i, m in enumerate(messages):
+        seq = first_seq + i
+        ops.append(('set', messages_ref.document(message_doc_id(seq)), {
+            'seq': seq,
+            'role': m['role'],
+            'text': m['text'],
+            'created_at': firestore.SERVER_TIMESTAMP,
+        }))
+
+    meta = {
+        'updated_at': firestore.SERVER_TIMESTAMP,
+        'message_count': first_seq + len(messages),
+    }
+    if chat_title:
+        meta['title'] = chat_title
+    if first_seq == 0:
+        meta['created_at'] = created_at
+        # drop the inline array left behind by the old storage format
+        meta['messages'] = firestore.DELETE_FIELD
+    ops.append(('merge', chat_ref, meta))
+    return ops
+
+
+def _append_messages(db, user_id, chat_id, chat_title, messages,
+                     created_at=firestore.SERVER_TIMESTAMP, migrate=False):
+    """Stores `messages` right after the chat's existing ones; returns [(first_seq, chunk)].
+
+    Seqs come from the chat doc's message_count, read and advanced in a transaction,
+    so two sessions appending to the same chat can't overwrite each other's turns.
+    With migrate=True nothing is written ([] is returned) unless the chat still holds
+    the old inline `messages` array, so two tabs can't migrate it twice.
+    """
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+
+    @firestore.transactional
+    def append(transaction, chunk, migrate):
+        snap = chat_ref.get(transaction=transaction)
+        data = (snap.to_dict() or {}) if snap.exists else {}
+        if migrate and not data.get('messages'):
+            return None
+        first_seq = data.get('message_count') or 0
+        for op, ref, payload in _save_ops(db, user_id, chat_id, chat_title, chunk, first_seq, created_at):
+            transaction.set(ref, payload, merge=(op == 'merge'))
+        return first_seq
+
+    stored = []
+    step = BATCH_LIMIT - 1  # one write is the chat doc itself
+    for i in range(0, len(messages), step):
+        chunk = messages[i:i + step]
+        try:
+            first_seq = append(db.transaction(), chunk, migrate and i == 0)
+        except ValueError as e:
+            # the client gives up on a contended transaction with a ValueError; it's transient
+            if isinstance(e.__cause__, gexc.Aborted):
+                raise e.__cause__
+            raise
+        if first_seq is None:
+            break
+        stored.append((first_seq, chunk))
+    return stored
+
+
+def _commit_index(db, ops):
+    # Search postings are best effort: a failure is logged and `export_chats.py --reindex` repairs it
+    try:
+        _commit_in_batches(db, ops)
+        return True
+    except Exception:
+        metrics.inc("search_index_errors_total")
+        logger.exception("could not update the search index")
+        return False
+
+
+def _title_ops(db, user_id, chat_id, chat_title):
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+    return [('merge', chat_ref, {'title': chat_title, 'updated_at': firestore.SERVER_TIMESTAMP})]
+
+
+def _clear_ops(db, user_id, chat_id):
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+    return ([('delete', ref, None) for ref in chat_ref.collection('messages').list_documents()]
+            + chat_search.unindex_ops(db, user_id, chat_id)
+            + [('merge', chat_ref, {'message_count': 0})])  # the next append starts at seq 0
+
+
+def _delete_ops(db, user_id, chat_id):
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+    return _clear_ops(db, user_id, chat_id) + [('delete', chat_ref, None)]
+
+
+@metrics.timed("save_chat")
+def save_chat(db, user_id, chat_id, chat_title, messages, created_at=firestore.SERVER_TIMESTAMP, migrate=False):
+    # Appends the new turns `messages`; returns the seq the first of them was stored at (None if nothing was)
+    stored = _append_messages(db, user_id, chat_id, chat_title, messages, created_at, migrate)
+    _commit_index(db, [op for first_seq, chunk in stored
+                       for op in chat_search.index_ops(db, user_id, chat_id, chunk, first_seq)])
+    if stored and stored[0][0] == 0:
+        invalidate_chat_list(user_id)
+    invalidate_search(user_id)
+    return stored[0][0] if stored else None
+
+
+def clear_chat_messages(db, user_id, chat_id):
+    _commit_in_batches(db, _clear_ops(db, user_id, chat_id))
+    invalidate_search(user_id)
+
+
+def load_chat_messages(db, user_id, chat_id, limit=MESSAGE_PAGE_SIZE, before_seq=None):
+    # Returns (messages, first_seq): the newest `limit` messages older than before_seq
+    chat_ref = chats_collection(db, user_id).document(chat_id)
+    query = chat_ref.collection('messages').order_by('seq', direction=firestore.Query.DESCENDING).limit(limit)
+    if before_seq is not None:
+        query = query.start_after({'seq': before_seq})
+    docs = list(query.stream())
+    docs.reverse()
+    if docs:
+        messages = [{'role': d.get('role'), 'text': d.get('text')} for d in docs]
+        return messages, docs[0].get('seq')
+    if before_seq is None:
+        # chats written before the subcollection layout keep everything inline;
+        # move them over once so later turns can be appended
+        snap = chat_ref.get()
+        data = snap.to_dict() if snap.exists else {}
+        legacy = data.get('messages', [])
+        if legacy:
+            save_chat(db, user_id, chat_id, data.get('title'), legacy,
+                      created_at=data.get('created_at') or firestore.SERVER_TIMESTAMP, migrate=True)
+            first_seq = max(len(legacy) - limit, 0)
+            return legacy[first_seq:], first_seq
+    return [], before_seq or 0
+
+
+def load_chat_title(db, user_id, chat_id):
+    snap = chats_collection(db, user_id).document(chat_id).get(field_paths=['title'])
+    return ((snap.to_dict() or {}).get('title') or '') if snap.exists else ''
+
+
+@metrics.timed("list_user_chats")
+def list_user_chats(db, user_id, page_size=CHAT_PAGE_SIZE, cursor=None):
+    # Returns (chats, next_cursor); pass next_cursor back in for the following page.
+    # Only id/title/created_at are fetched, and pages are cached briefly per user.
+    key = (cursor, page_size)
+    now = time.monotonic()
+    with _chat_list_lock:
+        hit = _chat_list_cache.get(user_id, {}).get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+
+    query = (
+        chats_collection(db, user_id)
+        .select(['title', 'created_at'])
+        .order_by('created_at', direction=firestore.Query.DESCENDING)
+        .limit(page_size + 1)
+    )
+    if cursor is not None:
+        query = query.start_after({'created_at': cursor})
+    docs = list(query.stream())
+    chats = []
+    for c in docs[:page_size]:
+        data = c.to_dict()
+        chats.append({
+            'id': c.id,
+            'title': data.get('title') or 'Untitled',
+            'created_at': data.get('created_at'),
+        })
+    next_cursor = chats[-1]['created_at'] if len(docs) > page_size else None
+    result = (chats, next_cursor)
+
+    with _chat_list_lock:
+        if len(_chat_list_cache) >= CHAT_LIST_CACHE_MAX:
+            for uid in [u for u, pages in _chat_list_cache.items()
+                        if all(exp <= now for exp, _ in pages.values())]:
+                del _chat_list_cache[uid]
+        _chat_list_cache.setdefault(user_id, {})[key] = (now + CHAT_LIST_TTL, result)
+    return result
+
+
+def invalidate_chat_list(user_id):
+    with _chat_list_lock:
+        _chat_list_cache.pop(user_id, None)
+
+
+def delete_chat(db, user_id, chat_id):
+    _commit_in_batches(db, _delete_ops(db, user_id, chat_id))
+    invalidate_chat_list(user_id)
+    invalidate_search(user_id)
+
+
+@metrics.timed("search_chats")
+def search_chats(db, user_id, query, limit=SEARCH_LIMIT):
+    # Ranked hits with the chat title and a snippet of the newest matching message.
+    # Reads only search docs for the query terms plus two docs per hit; cached briefly.
+    key = (" ".join(chat_search.tokenize(query)), limit)
+    if not key[0]:
+        return []
+    now = time.monotonic()
+    with _search_lock:
+        hit = _search_cache.get(user_id, {}).get(key)
+    if hit and hit[0] > now:
+        return hit[1]
+
+    hits = []
+    chats = chats_collection(db, user_id)
+    for h in chat_search.search(db, user_id, query, limit):
+        chat_ref = chats.document(h['chat_id'])
+        chat = chat_ref.get(field_paths=['title'])
+        if not chat.exists:
+            continue
+        message = chat_ref.collection('messages').document(message_doc_id(h['seq'])).get() if h['seq'] >= 0 else None
+        text = message.get('text') if message is not None and message.exists else ''
+        hits.append({**h, 'title': (chat.to_dict() or {}).get('title') or 'Untitled',
+                     'snippet': chat_search.snippet(text, query)})
+
+    with _search_lock:
+        if len(_search_cache) >= CHAT_LIST_CACHE_MAX:
+            _search_cache.clear()
+        _search_cache.setdefault(user_id, {})[key] = (now + SEARCH_TTL, hits)
+    return hits
+
+
+def invalidate_search(user_id):
+    with _search_lock:
+        _search_cache.pop(user_id, None)
+
+
+def reindex_chat(db, user_id, chat_id, messages):
+    # Rebuilds a chat's postings from its full transcript (chats saved before search existed)
+    _commit_in_batches(db, chat_search.unindex_ops(db, user_id, chat_id)
+                       + chat_search.index_ops(db, user_id, chat_id, messages))
+    invalidate_search(user_id)
+
+
+def iter_chat_pages(db, user_id=None, page_size=EXPORT_PAGE_SIZE, after=None):
+    """Yields pages (lists) of chat snapshots in document-path order.
+
+    Walks one user's chats, or every users/*/chats when user_id is None. Only one
+    page is held at a time; `after` is a chat document path to resume behind. It is
+    used as a path cursor, so the chat doesn't need to exist any more and isn't read.
+    """
+    if user_id:
+        query = chats_collection(db, user_id)
+    else:
+        query = db.collection_group('chats')
+    query = query.order_by(FieldPath.document_id()).limit(page_size)
+    cursor = db.document(after) if after else None
+    while True:
+        docs = list((query.start_after({FieldPath.document_id(): cursor}) if cursor is not None else query).stream())
+        if docs:
+            yield docs
+        if len(docs) < page_size:
+            return
+        cursor = docs[-1].reference
+
+
+def iter_chat_messages(db, user_id, chat_id, page_size=EXPORT_PAGE_SIZE):
+    # Every stored message of a chat in seq order, a page at a time
+    query = (chats_collection(db, user_id).document(chat_id).collection('messages')
+             .order_by('seq').limit(page_size))
+    last = None
+    while True:
+        docs = list((query.start_after({'seq': last}) if last is not None else query).stream())
+        for d in docs:
+            yield d.to_dict()
+        if len(docs) < page_size:
+            return
+        last = docs[-1].get('seq')
+
+
+def set_titles(db, titles):
+    # Bulk (user_id, chat_id, title) writes for maintenance jobs; leaves updated_at alone
+    _commit_in_batches(db, [('merge', chats_collection(db, user_id).document(chat_id), {'title': title})
+                            for user_id, chat_id, title in titles])
+    for user_id in {user_id for user_id, _, _ in titles}:
+        invalidate_chat_list(user_id)
+
+
+def _coalesce(ops, op):
+    # Folds a new mutation into the ones already pending for the same chat
+    kind, data = op
+    if kind in ('delete', 'clear'):
+        # wipes whatever was queued before it
+        ops[:] = [op]
+        return
+    if ops:
+        last_kind, last = ops[-1]
+        if (kind == 'save' and last_kind == 'save'
+                and last['first_seq'] + len(last['messages']) == data['first_seq']):
+            last['messages'] = last['messages'] + data['messages']
+            last['title'] = data['title'] or last['title']
+            return
+        if kind == 'title' and last_kind in ('save', 'title'):
+            last['title'] = data['title']
+            return
+    ops.append(op)
+
+
+class WriteBehindQueue:
+    """Background writer for chat mutations so the script thread never waits on Firestore.
+
+    Mutations are queued per (user_id, chat_id) and coalesced: consecutive appends
+    merge into one save, a clear or delete drops what was queued before it. A daemon
+    thread flushes everything, retrying transient errors with backoff. Appends run in
+    a transaction per chat that reserves their seqs; other mutations are packed into
+    shared batches. If a batch still fails, its chats are retried one at a time so one
+    bad chat can't hold back the others; a chat that fails again is put back for the next
+    flush, unless the error is permanent or it has failed `max_attempts` flushes, in
+    which case its writes are logged and dropped (dead-lettered). flush() can be
+    called to write synchronously (logout) and is registered to run at interpreter exit.
+    """
+
+    def __init__(self, get_db, interval=0.5, max_retries=3, backoff_base=0.5, max_attempts=5):
+        self._get_db = get_db
+        self.interval = interval
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_attempts = max_attempts
+        self.dead_lettered = 0
+        self._pending = OrderedDict()  # (user_id, chat_id) -> [(kind, data), ...]
+        self._attempts = {}  # (user_id, chat_id) -> failed flushes so far
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def save(self, user_id, chat_id, chat_title, messages, first_seq=0):
+        # first_seq is the session's own count, only used to coalesce appends; the
+        # stored seqs are reserved when the save is written
+        self._enqueue(user_id, chat_id, ('save', {
+            'title': chat_title, 'messages': list(messages), 'first_seq': first_seq,
+        }))
+
+    def update_title(self, user_id, chat_id, chat_title):
+        self._enqueue(user_id, chat_id, ('title', {'title': chat_title}))
+
+    def clear(self, user_id, chat_id):
+        self._enqueue(user_id, chat_id, ('clear', {}))
+
+    def delete(self, user_id, chat_id):
+        self._enqueue(user_id, chat_id, ('delete', {}))
+
+    def pending(self):
+        with self._lock:
+            return sum(len(ops) for ops in self._pending.values())
+
+    def _enqueue(self, user_id, chat_id, op):
+        with self._lock:
+            _coalesce(self._pending.setdefault((user_id, chat_id), []), op)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)  # give a burst of writes time to coalesce
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("write-behind flush failed")
+
+    def _build(self, db, user_id, chat_id, ops):
+        # Batch writes for a chat's title / clear / delete mutations
+        writes = []
+        for kind, data in ops:
+            if kind == 'title':
+                writes += _title_ops(db, user_id, chat_id, data['title'])
+            elif kind == 'clear':
+                writes += _clear_ops(db, user_id, chat_id)
+            elif kind == 'delete':
+                writes += _delete_ops(db, user_id, chat_id)
+        return writes
+
+    def _apply(self, db, key, ops, index_writes):
+        # Runs a chat's mutations in order, dropping each from `ops` once it is stored,
+        # so a failure part way through re-queues only what is left
+        user_id, chat_id = key
+        while ops:
+            kind, data = ops[0]
+            if kind == 'save':
+                stored = _append_messages(db, user_id, chat_id, data['title'], data['messages'])
+                for first_seq, chunk in stored:
+                    index_writes += chat_search.index_ops(db, user_id, chat_id, chunk, first_seq)
+                if stored and stored[0][0] == 0:
+                    invalidate_chat_list(user_id)
+            else:
+                _commit_in_batches(db, self._build(db, user_id, chat_id, [ops[0]]))
+            ops.pop(0)
+
+    def _with_retry(self, write, retries):
+        # None once write() succeeded, else the error that made it give up
+        for attempt in range(retries + 1):
+            try:
+                write()
+                return None
+            except Exception as e:
+                if isinstance(e, PERMANENT_ERRORS) or attempt == retries:
+                    return e
+                time.sleep(random.uniform(0, self.backoff_base * (2 ** attempt)))
+
+    def flush(self):
+        # Writes everything queued so far; returns False if some chats were re-queued or dropped
+        with self._flush_lock, metrics.span("write_behind_flush"):
+            with self._lock:
+                pending, self._pending = self._pending, OrderedDict()
+            if not pending:
+                return True
+            db = self._get_db()
+
+            ok = True
+            committed, built = [], {}  # built: chat -> its search index writes
+            # pack whole chats into batches so a failure maps back to the chats it covered
+            groups, group, group_writes = [], [], []
+            for key, ops in pending.items():
+                if any(kind == 'save' for kind, _ in ops):
+                    built[key] = []
+                    error = self._with_retry(lambda: self._apply(db, key, ops, built[key]), self.max_retries)
+                    if error is None:
+                        committed.append(key)
+                        self._committed(key, [])
+                    else:
+                        self._failed(key, ops, error)
+                        ok = False
+                    continue
+                try:
+                    writes = self._build(db, key[0], key[1], ops)
+                except Exception as e:
+                    self._failed(key, ops, e)
+                    ok = False
+                    continue
+                if group and len(group_writes) + len(writes) > BATCH_LIMIT:
+                    groups.append((group, group_writes))
+                    group, group_writes = [], []
+                group.append((key, ops, writes))
+                group_writes += writes
+            if group:
+                groups.append((group, group_writes))
+
+            for group, writes in groups:
+                error = self._with_retry(lambda: _commit_in_batches(db, writes), self.max_retries)
+                if error is None:
+                    for key, ops, _ in group:
+                        committed.append(key)
+                        self._committed(key, ops)
+                    continue
+                if len(group) == 1:
+                    key, ops, _ = group[0]
+                    self._failed(key, ops, error)
+                    ok = False
+                    continue
+                # one bad chat must not hold back the others packed with it
+                for key, ops, chat_writes in group:
+                    chat_error = self._with_retry(lambda: _commit_in_batches(db, chat_writes), 0)
+                    if chat_error is None:
+                        committed.append(key)
+                        self._committed(key, ops)
+                    else:
+                        self._failed(key, ops, chat_error)
+                        ok = False
+
+            # postings only for messages that are stored, and never in the same batch
+            index_writes = [w for writes in built.values() for w in writes]
+            if index_writes and self._with_retry(lambda: _commit_in_batches(db, index_writes),
+                                                 self.max_retries) is not None:
+                for writes in built.values():
+                    _commit_index(db, writes)
+            for user_id in {key[0] for key in committed}:
+                invalidate_search(user_id)
+            return ok
+
+    def _committed(self, key, ops):
+        self._attempts.pop(key, None)
+        if any(kind in ('delete', 'title') for kind, _ in ops):
+            invalidate_chat_list(key[0])
+
+    def _failed(self, key, ops, error):
+        attempts = self._attempts.get(key, 0) + 1
+        if isinstance(error, PERMANENT_ERRORS) or attempts >= self.max_attempts:
+            self._attempts.pop(key, None)
+            self.dead_lettered += 1
+            metrics.inc("write_behind_dead_letters_total", reason=type(error).__name__)
+            logger.error("dropping %d queued write(s) for chat %s of user %s after %d attempt(s): %r; ops: %s",
+                         len(ops), key[1], key[0], attempts, error,
+                         [(kind, len(data.get('messages', ()))) for kind, data in ops])
+            return
+        self._attempts[key] = attempts
+        logger.warning("write-behind commit for chat %s failed (attempt %d of %d): %r",
+                       key[1], attempts, self.max_attempts, error)
+        self._requeue({key: ops})
+
+    def _requeue(self, failed):
+        with self._lock:
+            for key, ops in failed.items():
+                newer = self._pending.pop(key, [])
+                merged = list(ops)
+                for op in newer:
+                    _coalesce(merged, op)
+                self._pending[key] = merged
+                self._pending.move_to_end(key, last=False)
+        self._wake.set()
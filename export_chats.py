@@ -0,0 +1,232 @@
+"""Export chats to NDJSON and backfill missing titles, one page of chats at a time.
+
+    python export_chats.py --out chats.ndjson.gz
+    python export_chats.py --user alice --out -
+    python export_chats.py --backfill-titles --titles-per-sec 2 --checkpoint titles.json
+    python export_chats.py --out all.ndjson.gz --checkpoint export.json   # re-run to resume
+    python export_chats.py --reindex --checkpoint reindex.json
+
+Chats under users/*/chats (or one --user's) are read in document-path order with
+cursor pagination, so memory stays at one page of chats. Each output line is a chat:
+{"user_id", "chat_id", "title", "created_at", "updated_at", "message_count", "messages"}.
+A .gz --out is gzip-compressed.
+
+--backfill-titles generates titles for chats that are untitled (or 'Untitled') from
+their first exchange, using the app's title prompt, rate-limited to --titles-per-sec.
+With --checkpoint, progress is saved after every page; re-running resumes behind the
+last finished page and appends to --out, so a crash repeats at most one page.
+
+--reindex rebuilds every chat's search postings from its full transcript, for
+chats saved before search existed.
+
+Firestore credentials come from --credentials FILE, else $FIREBASE_SERVICE_ACCOUNT,
+else FIREBASE_SERVICE_ACCOUNT in .streamlit/secrets.toml. Titles use $GEMINI_API_KEY.
+"""
+import argparse
+import datetime
+import gzip
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dotenv import load_dotenv
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    import tomli as tomllib
+
+import chat_context
+import chat_store
+from admission import TokenBucket
+from firestore_db import FirestoreResource
+from gemini_client import GEMINI_BASE_URL, GeminiClient, GeminiError
+
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+
+def load_service_account(path=None):
+    if path:
+        with open(path) as f:
+            return json.load(f)
+    if os.getenv("FIREBASE_SERVICE_ACCOUNT"):
+        return json.loads(os.environ["FIREBASE_SERVICE_ACCOUNT"])
+    if os.path.exists(SECRETS_PATH):
+        with open(SECRETS_PATH, "rb") as f:
+            info = tomllib.load(f).get("FIREBASE_SERVICE_ACCOUNT")
+        if info:
+            return json.loads(info) if isinstance(info, str) else info
+    raise SystemExit("No Firestore credentials: pass --credentials or set FIREBASE_SERVICE_ACCOUNT")
+
+
+def open_output(path, append):
+    if path == "-":
+        return sys.stdout
+    mode = "at" if append else "wt"
+    if path.endswith(".gz"):
+        return gzip.open(path, mode, encoding="utf-8")  # appending adds a gzip member, still one stream
+    return open(path, mode, encoding="utf-8")
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(path, cursor, stats):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({"cursor": cursor, "stats": stats}, f)
+    os.replace(tmp, path)
+
+
+def json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def chat_owner(snap):
+    # users/{user_id}/chats/{chat_id}; anything else named "chats" is skipped
+    parts = snap.reference.path.split("/")
+    return parts[1] if len(parts) == 4 and parts[0] == "users" else None
+
+
+def needs_title(data):
+    return not data.get("title") or data.get("title") == "Untitled"
+
+
+def chat_messages(db, user_id, snap, data, limit=None):
+    legacy = data.get("messages")
+    if legacy:
+        messages = ({"seq": i, **m} for i, m in enumerate(legacy))
+    else:
+        messages = chat_store.iter_chat_messages(db, user_id, snap.id, page_size=limit or chat_store.EXPORT_PAGE_SIZE)
+    return list(itertools.islice(messages, limit))
+
+
+class TitleBackfill:
+    """Generates titles for a page of chats on a few threads, sharing one token bucket."""
+
+    def __init__(self, client, rate, workers):
+        self.client = client
+        self.bucket = TokenBucket(rate, max(1.0, rate), time.monotonic())
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _wait_for_token(self):
+        while True:
+            with self.lock:
+                wait = self.bucket.take(time.monotonic())
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def _title(self, messages):
+        self._wait_for_token()
+        try:
+            text = self.client.generate([{"parts": [{"text": chat_context.title_prompt(messages)}]}])
+        except GeminiError:
+            return None
+        return chat_context.clean_title(text) or None
+
+    def run(self, db, jobs):
+        # jobs: [(user_id, chat_id, opening messages)] -> {chat path: title} that were written
+        titles = list(self.pool.map(lambda job: self._title(job[2]), jobs))
+        updates = [(user_id, chat_id, title) for (user_id, chat_id, _), title in zip(jobs, titles) if title]
+        if updates:
+            chat_store.set_titles(db, updates)
+        return {(user_id, chat_id): title for user_id, chat_id, title in updates}
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def run(db, args, backfill=None, log=sys.stderr):
+    checkpoint = load_checkpoint(args.checkpoint)
+    stats = checkpoint.get("stats") or {"chats": 0, "messages": 0, "titled": 0, "title_failures": 0, "reindexed": 0}
+    after = checkpoint.get("cursor")  # path of the last chat done; fine if it was deleted since
+    out = open_output(args.out, append=after is not None) if args.out else None
+    started = time.monotonic()
+    try:
+        for page in chat_store.iter_chat_pages(db, args.user, args.page_size, after):
+            records, jobs = [], []
+            for snap in page:
+                user_id = chat_owner(snap)
+                if user_id is None:
+                    continue
+                data = snap.to_dict() or {}
+                messages = None
+                if out or args.reindex:
+                    messages = chat_messages(db, user_id, snap, data)
+                if args.reindex and not data.get("messages"):
+                    # legacy inline chats get indexed when the app migrates them
+                    chat_store.reindex_chat(db, user_id, snap.id, messages)
+                    stats["reindexed"] = stats.get("reindexed", 0) + 1
+                if out:
+                    data.pop("messages", None)
+                    records.append({"user_id": user_id, "chat_id": snap.id, **data, "messages": messages})
+                if backfill and needs_title(data):
+                    opening = messages[:2] if messages is not None else chat_messages(db, user_id, snap, data, limit=2)
+                    if opening:
+                        jobs.append((user_id, snap.id, opening))
+
+            if jobs:
+                titles = backfill.run(db, jobs)
+                stats["titled"] += len(titles)
+                stats["title_failures"] += len(jobs) - len(titles)
+                for record in records:
+                    record["title"] = titles.get((record["user_id"], record["chat_id"]), record.get("title"))
+            if out:
+                for record in records:
+                    out.write(json.dumps(record, default=json_default, ensure_ascii=False) + "\n")
+                    stats["messages"] += len(record["messages"])
+                out.flush()
+            stats["chats"] += len(page)
+            if args.checkpoint:
+                save_checkpoint(args.checkpoint, page[-1].reference.path, stats)
+            elapsed = time.monotonic() - started
+            print(f"{stats['chats']} chats, {stats['messages']} messages, {stats['titled']} titled "
+                  f"({stats['title_failures']} failed), {elapsed:.0f}s", file=log)
+    finally:
+        if out and out is not sys.stdout:
+            out.close()
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--out", help="NDJSON file to write (.gz to compress, - for stdout)")
+    parser.add_argument("--user", help="only this user's chats")
+    parser.add_argument("--backfill-titles", action="store_true")
+    parser.add_argument("--reindex", action="store_true", help="rebuild search postings")
+    parser.add_argument("--titles-per-sec", type=float, default=1.0)
+    parser.add_argument("--title-workers", type=int, default=4)
+    parser.add_argument("--checkpoint", help="JSON file to save progress to and resume from")
+    parser.add_argument("--page-size", type=int, default=chat_store.EXPORT_PAGE_SIZE)
+    parser.add_argument("--credentials", help="service-account JSON file")
+    args = parser.parse_args(argv)
+    if not (args.out or args.backfill_titles or args.reindex):
+        parser.error("nothing to do: pass --out, --backfill-titles and/or --reindex")
+
+    load_dotenv()
+    db = FirestoreResource(load_service_account(args.credentials)).client()
+    backfill = None
+    if args.backfill_titles:
+        client = GeminiClient(os.getenv("GEMINI_API_KEY"), base_url=os.getenv("GEMINI_API_BASE", GEMINI_BASE_URL))
+        backfill = TitleBackfill(client, args.titles_per_sec, args.title_workers)
+    try:
+        run(db, args, backfill)
+    finally:
+        if backfill:
+            backfill.close()
+
+
+if __name__ == "__main__":
+    main()
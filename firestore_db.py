@@ -0,0 +1,67 @@
+import threading
+import time
+
+from google.cloud import firestore
+
+
+class FirestoreResource:
+    """Owns the single Firestore client for the process.
+
+    The client (service-account parsing, token exchange, gRPC channel) is built
+    once and shared by every session. A daemon thread builds it eagerly and then
+    pings Firestore periodically, replacing the client if the ping keeps failing.
+    """
+
+    def __init__(self, service_account_info, health_interval=60.0, max_failures=3):
+        self._info = service_account_info
+        self._client = None
+        self._lock = threading.Lock()
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+        self.failures = 0
+        self.last_ok = None
+        self._monitor = None
+
+    def client(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = firestore.Client.from_service_account_info(self._info)
+                client = self._client
+        return client
+
+    def ping(self):
+        try:
+            list(self.client().collection('users').limit(1).select([]).stream())
+        except Exception:
+            self.failures += 1
+            return False
+        self.failures = 0
+        self.last_ok = time.time()
+        return True
+
+    def healthy(self):
+        return self.failures < self.max_failures
+
+    def reset(self):
+        with self._lock:
+            client, self._client = self._client, None
+        if client is not None:
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def warm_up(self):
+        # Build the client and open the channel off the script thread, then keep checking it
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._run, name="firestore-health", daemon=True)
+            self._monitor.start()
+
+    def _run(self):
+        while True:
+            if not self.ping() and not self.healthy():
+                self.reset()
+                self.failures = 0
+            time.sleep(self.health_interval)
@@ -0,0 +1,193 @@
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/models"
+GEMINI_MODEL = "gemini-2.0-flash"
+
+# 429 and transient server errors are worth another try; everything else is final
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class GeminiError(Exception):
+    pass
+
+
+class GeminiCancelled(GeminiError):
+    pass
+
+
+class CancelToken:
+    """Lets another thread abort a streaming call: cancel() closes the live HTTP response."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._response = None
+
+    def cancelled(self):
+        return self._event.is_set()
+
+    def attach(self, response):
+        with self._lock:
+            self._response = response
+        if self.cancelled():
+            response.close()
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            response = self._response
+        if response is not None:
+            response.close()
+
+
+def extract_text(res_json):
+    try:
+        parts = res_json['candidates'][0]['content']['parts']
+    except (KeyError, IndexError, TypeError):
+        return ""
+    return "".join(p.get('text', '') for p in parts)
+
+
+class GeminiClient:
+    """Thread-safe Gemini client meant to be shared by every session in the process.
+
+    Keeps a pooled keep-alive session, applies connect/read timeouts, retries
+    429/5xx with jittered exponential backoff and caps the number of requests
+    in flight with a bounded semaphore.
+    """
+
+    def __init__(self, api_key, model=GEMINI_MODEL, base_url=GEMINI_BASE_URL,
+                 connect_timeout=5.0, read_timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, max_concurrency=16,
+                 queue_timeout=30.0):
+        self.model = model
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.queue_timeout = queue_timeout
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # key goes in a header so it never shows up in URLs or access logs
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "x-goog-api-key": api_key or "",
+        })
+
+    def _url(self, method):
+        return f"{self.base_url}/{self.model}:{method}"
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try:
+                delay = max(delay, min(float(retry_after), self.backoff_max))
+            except ValueError:
+                pass
+        time.sleep(delay)
+
+    def _acquire(self):
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            metrics.inc("gemini_errors_total", reason="concurrency_limit")
+            raise GeminiError("Too many concurrent Gemini requests, please try again.")
+
+    def _post(self, method, payload, stream=False, params=None, cancel=None):
+        body = json.dumps(payload).encode()
+        for attempt in range(self.max_retries + 1):
+            if cancel is not None and cancel.cancelled():
+                raise GeminiCancelled("cancelled")
+            metrics.inc("gemini_requests_total", method=method)
+            metrics.inc("gemini_request_bytes_total", len(body))
+            try:
+                response = self.session.post(
+                    self._url(method), data=body, params=params,
+                    stream=stream, timeout=self.timeout,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries:
+                    metrics.inc("gemini_errors_total", reason=type(e).__name__)
+                    raise GeminiError(str(e)) from e
+                metrics.inc("gemini_retries_total", reason=type(e).__name__)
+                self._backoff(attempt)
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < self.max_retries:
+                metrics.inc("gemini_retries_total", reason=str(response.status_code))
+                retry_after = response.headers.get("Retry-After")
+                response.close()
+                self._backoff(attempt, retry_after)
+                continue
+            if not response.ok:
+                metrics.inc("gemini_errors_total", reason=str(response.status_code))
+                text = response.text
+                response.close()
+                raise GeminiError(text)
+            return response
+
+    def generate(self, contents):
+        self._acquire()
+        try:
+            response = self._post("generateContent", {"contents": contents})
+            try:
+                return extract_text(response.json())
+            except ValueError:
+                return ""
+        finally:
+            self._slots.release()
+
+    def stream(self, contents, cancel=None):
+        # Generator: holds its concurrency slot until exhausted or closed.
+        # Retries only happen before the first byte, never mid-stream.
+        # cancel (a CancelToken) may be fired from any thread; the stream then just ends.
+        self._acquire()
+        try:
+            try:
+                response = self._post("streamGenerateContent", {"contents": contents},
+                                      stream=True, params={"alt": "sse"}, cancel=cancel)
+            except GeminiCancelled:
+                return
+            if cancel is not None:
+                cancel.attach(response)
+            with response:
+                response.encoding = "utf-8"
+                # chunk_size=None hands over events as they arrive instead of buffering 512 bytes
+                try:
+                    for line in response.iter_lines(chunk_size=None, decode_unicode=True):
+                        if cancel is not None and cancel.cancelled():
+                            break
+                        if not line or not line.startswith("data:"):
+                            continue
+                        try:
+                            text = extract_text(json.loads(line[5:]))
+                        except ValueError:
+                            continue
+                        if text:
+                            yield text
+                except Exception as e:
+                    # closing the response under iter_lines surfaces as assorted errors
+                    if cancel is not None and cancel.cancelled():
+                        metrics.inc("gemini_cancelled_total")
+                        return
+                    if not isinstance(e, requests.RequestException):
+                        raise
+                    metrics.inc("gemini_errors_total", reason=type(e).__name__)
+                    raise GeminiError(str(e)) from e
+            if cancel is not None and cancel.cancelled():
+                metrics.inc("gemini_cancelled_total")
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,85 @@
+"""Gemini answers produced on a background thread, one at a time per session.
+
+The script starts a Generation and returns right away; a polling fragment reads
+the text streamed so far. cancel() aborts the upstream HTTP request, so a Stop
+click or a newer message never leaves an orphaned call burning quota.
+"""
+import threading
+
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+import metrics
+from admission import RateLimited
+from gemini_client import CancelToken
+
+
+class Generation:
+    """Runs `produce(cancel)` (an iterable of text chunks) on a daemon thread.
+
+    If an admission `ticket` is given, the worker first waits for its slot and
+    releases it when done. `status` moves through queued -> running -> done,
+    or ends in stopped / failed.
+    """
+
+    def __init__(self, produce, ticket=None):
+        self._produce = produce
+        self._ticket = ticket
+        self._chunks = []
+        self._lock = threading.Lock()
+        self._finished = threading.Event()
+        self.cancel_token = CancelToken()
+        self.status = "queued" if ticket is not None else "running"
+        self.error = None
+
+    def start(self):
+        thread = threading.Thread(target=self._run, name="gemini-generation", daemon=True)
+        # cache_resource lookups from the worker need the session's script context
+        add_script_run_ctx(thread, get_script_run_ctx())
+        thread.start()
+        return self
+
+    def _run(self):
+        try:
+            if self._ticket is not None:
+                while not self._ticket.wait(0.25):
+                    if self.cancel_token.cancelled():
+                        return
+                self.status = "running"
+            with metrics.span("generation"):
+                for chunk in self._produce(self.cancel_token):
+                    with self._lock:
+                        self._chunks.append(chunk)
+                    if self.cancel_token.cancelled():
+                        break
+        except RateLimited as e:
+            self.error = e
+            self.status = "failed"
+        except Exception as e:
+            self.error = e
+            self.status = "failed"
+            metrics.inc("generation_errors_total", reason=type(e).__name__)
+        finally:
+            if self._ticket is not None:
+                self._ticket.release()
+            if self.status in ("queued", "running"):
+                self.status = "stopped" if self.cancel_token.cancelled() else "done"
+            self._finished.set()
+
+    def text(self):
+        with self._lock:
+            return "".join(self._chunks)
+
+    def position(self):
+        return self._ticket.position() if self._ticket is not None and self.status == "queued" else 0
+
+    @property
+    def done(self):
+        return self._finished.is_set()
+
+    def cancel(self):
+        if not self.done:
+            metrics.inc("generation_cancelled_total")
+        self.cancel_token.cancel()
+
+    def join(self, timeout=None):
+        return self._finished.wait(timeout)
@@ -0,0 +1,129 @@
+"""Process-wide, size-capped storage for guest conversations.
+
+Guest chats are never saved, but they used to live in session_state as lists of
+dicts for as long as the browser tab stayed open. Here each guest session keeps
+compact (role, text) entries -- long texts zlib-compressed -- under a turn and
+byte cap, and sessions that go idle, or the least recently used ones when the
+process-wide budget is exceeded, are evicted. Nothing else per guest is kept in
+session_state; the one thing held outside the store (the rolling context summary)
+is released through `on_evict`.
+"""
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+
+COMPRESS_MIN = 512  # bytes; shorter texts aren't worth compressing
+ENTRY_OVERHEAD = 120  # rough per-message bookkeeping (tuple + bytes object headers)
+
+
+def _pack(text):
+    data = text.encode("utf-8")
+    if len(data) >= COMPRESS_MIN:
+        packed = zlib.compress(data, 6)
+        if len(packed) < len(data):
+            return True, packed
+    return False, data
+
+
+def _unpack(zipped, data):
+    return (zlib.decompress(data) if zipped else data).decode("utf-8")
+
+
+class GuestSession:
+    def __init__(self, max_messages, max_bytes):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self._entries = deque()  # (is_user, zipped, data)
+        self.base = 0  # seq of the oldest kept message; older ones were dropped
+        self.nbytes = 0
+        self.last_seen = time.monotonic()
+
+    def append(self, role, text):
+        """Adds a message, dropping the oldest ones past the caps. Returns the byte delta."""
+        zipped, data = _pack(text)
+        self._entries.append((role == "user", zipped, data))
+        before = self.nbytes
+        self.nbytes += len(data) + ENTRY_OVERHEAD
+        # always keep the newest message, even if it alone is over the byte cap
+        while len(self._entries) > 1 and (len(self._entries) > self.max_messages or self.nbytes > self.max_bytes):
+            _, _, old = self._entries.popleft()
+            self.nbytes -= len(old) + ENTRY_OVERHEAD
+            self.base += 1
+        return self.nbytes - before
+
+    def messages(self):
+        # Materialized for one script run; the dicts are garbage once the run ends
+        return [{"role": "user" if is_user else "gemini", "text": _unpack(zipped, data)}
+                for is_user, zipped, data in self._entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class GuestStore:
+    def __init__(self, max_messages=100, max_session_bytes=256 * 1024,
+                 max_total_bytes=256 * 1024 * 1024, idle_ttl=1800.0, sweep_interval=30.0, on_evict=None):
+        self.max_messages = max_messages
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.idle_ttl = idle_ttl
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict  # called with the session id, to free state kept elsewhere
+        self.total_bytes = 0
+        self.evicted = 0
+        self._sessions = OrderedDict()  # session id -> GuestSession, least recently used first
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+
+    def get(self, session_id):
+        """The session's conversation, created empty if new (or evicted)."""
+        now = time.monotonic()
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self._sessions[session_id] = GuestSession(self.max_messages, self.max_session_bytes)
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_seen = now
+            if now - self._last_sweep >= self.sweep_interval:
+                self._evict_idle(now)
+            return session
+
+    def append(self, session_id, role, text):
+        session = self.get(session_id)
+        with self._lock:
+            self.total_bytes += session.append(role, text)
+            self._evict_over_budget(keep=session_id)
+
+    def drop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+            if session is not None:
+                self.total_bytes -= session.nbytes
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict_idle(self, now):
+        self._last_sweep = now
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if now - session.last_seen < self.idle_ttl:
+                break  # LRU order: everything after this was seen more recently
+            self._remove(session_id)
+
+    def _evict_over_budget(self, keep):
+        while self.total_bytes > self.max_total_bytes and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                self._sessions.move_to_end(keep)
+                continue
+            self._remove(session_id)
+
+    def _remove(self, session_id):
+        session = self._sessions.pop(session_id)
+        self.total_bytes -= session.nbytes
+        self.evicted += 1
+        if self.on_evict is not None:
+            self.on_evict(session_id)
@@ -0,0 +1,198 @@
+"""Process-wide, dependency-free metrics: timing spans, counters and gauges.
+
+Everything is aggregated in module state, so it is shared by every Streamlit
+session in the server process. Spans keep a bounded reservoir of recent
+durations for percentiles; exposition is Prometheus text format.
+"""
+import functools
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PREFIX = "chatbot_"
+RESERVOIR_SIZE = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+_lock = threading.Lock()
+_spans = {}      # name -> _Span
+_counters = {}   # (name, labels) -> value
+_callbacks = {}  # name -> (kind, help, fn)
+_help = {}
+
+
+class _Span:
+    __slots__ = ("count", "total", "errors", "recent")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.recent = deque(maxlen=RESERVOIR_SIZE)
+
+    def quantiles(self):
+        ordered = sorted(self.recent)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, error=False):
+    with _lock:
+        s = _spans.get(name)
+        if s is None:
+            s = _spans[name] = _Span()
+        s.count += 1
+        s.total += seconds
+        s.recent.append(seconds)
+        if error:
+            s.errors += 1
+
+
+class span:
+    """Times a block: ``with metrics.span("save_chat"): ...``; exceptions count as errors."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        observe(self.name, time.perf_counter() - self._start, error=exc_type is not None)
+        return False
+
+
+def timed(name):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def inc(name, value=1, help_text=None, **labels):
+    key = (name, _labels_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+        if help_text:
+            _help.setdefault(name, help_text)
+
+
+def register_callback(name, fn, kind="gauge", help_text=""):
+    # fn() is evaluated at scrape time; use for values owned by other objects (cache hits, queue depth)
+    with _lock:
+        _callbacks[name] = (kind, help_text, fn)
+
+
+def snapshot():
+    """Plain-data view for the admin panel: spans with percentiles (ms), counters, callbacks."""
+    with _lock:
+        spans = {
+            name: {
+                "count": s.count,
+                "errors": s.errors,
+                "mean_ms": s.total / s.count * 1000 if s.count else 0.0,
+                **{f"p{int(q * 100)}_ms": v * 1000 for q, v in s.quantiles().items()},
+            }
+            for name, s in _spans.items()
+        }
+        counters = {}
+        for (name, labels), value in _counters.items():
+            label_text = ",".join(f"{k}={v}" for k, v in labels)
+            counters[f"{name}{{{label_text}}}" if label_text else name] = value
+        callbacks = dict(_callbacks)
+    for name, (_, _, fn) in callbacks.items():
+        try:
+            counters[name] = fn()
+        except Exception:
+            pass
+    return {"spans": spans, "counters": counters}
+
+
+def _fmt_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        spans = [(name, s.count, s.total, s.errors, s.quantiles()) for name, s in sorted(_spans.items())]
+        counters = sorted(_counters.items())
+        callbacks = sorted(_callbacks.items())
+        helps = dict(_help)
+
+    if spans:
+        lines.append(f"# HELP {PREFIX}span_seconds Duration of instrumented hot-path operations.")
+        lines.append(f"# TYPE {PREFIX}span_seconds summary")
+        for name, count, total, _, quantiles in spans:
+            for q, v in quantiles.items():
+                lines.append(f'{PREFIX}span_seconds{{span="{name}",quantile="{q}"}} {v:.6f}')
+            lines.append(f'{PREFIX}span_seconds_sum{{span="{name}"}} {total:.6f}')
+            lines.append(f'{PREFIX}span_seconds_count{{span="{name}"}} {count}')
+        lines.append(f"# HELP {PREFIX}span_errors_total Instrumented operations that raised.")
+        lines.append(f"# TYPE {PREFIX}span_errors_total counter")
+        for name, _, _, errors, _ in spans:
+            lines.append(f'{PREFIX}span_errors_total{{span="{name}"}} {errors}')
+
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            seen.add(name)
+            if name in helps:
+                lines.append(f"# HELP {PREFIX}{name} {helps[name]}")
+            lines.append(f"# TYPE {PREFIX}{name} counter")
+        lines.append(f"{PREFIX}{name}{_fmt_labels(labels)} {value}")
+
+    for name, (kind, help_text, fn) in callbacks:
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if help_text:
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+        lines.append(f"# TYPE {PREFIX}{name} {kind}")
+        lines.append(f"{PREFIX}{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        _callbacks.clear()
+        _help.clear()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port, host="0.0.0.0"):
+    # Streamlit can't add routes, so /metrics gets its own small server thread
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_prompt(prompt):
+    # "Hi!", "hi" and "  HI  " should all land on the same entry
+    return _WHITESPACE.sub(" ", prompt).strip().casefold().rstrip("?!.")
+
+
+def make_key(prompt, model, context=None):
+    context_hash = hashlib.sha256(
+        json.dumps(context or [], sort_keys=True, ensure_ascii=False).encode()
+    ).hexdigest()
+    raw = "\x1f".join([model, context_hash, normalize_prompt(prompt)])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class ResponseCache:
+    """Process-wide cache of Gemini answers.
+
+    An in-memory LRU with per-entry TTL sits in front of an optional SQLite
+    table so warm entries survive a restart. All methods are thread-safe.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, db_path=None, max_disk_entries=50000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_disk_entries = max_disk_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, text)
+        self._lock = threading.Lock()
+        self._db = None
+        self._puts = 0
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, text TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_expiry ON responses (expires_at)")
+            self._db.commit()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT text, expires_at FROM responses WHERE key = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                if row:
+                    self._remember(key, row[1], row[0])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def put(self, key, text):
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, expires_at, text)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO responses (key, text, expires_at) VALUES (?, ?, ?)",
+                    (key, text, expires_at),
+                )
+                self._puts += 1
+                if self._puts % 100 == 0:
+                    self._prune_disk()
+                self._db.commit()
+
+    def _remember(self, key, expires_at, text):
+        self._entries[key] = (expires_at, text)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (time.time(),))
+        self._db.execute(
+            "DELETE FROM responses WHERE key NOT IN "
+            "(SELECT key FROM responses ORDER BY expires_at DESC LIMIT ?)",
+            (self.max_disk_entries,),
+        )
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
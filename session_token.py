@@ -0,0 +1,121 @@
+"""Signed, expiring login cookies and a small cache of user profiles.
+
+A token is base64url(JSON claims) + "." + base64url(HMAC-SHA256), with claims
+    u: user id, iat: issued at, exp: expires at, c: chat id to resume (optional).
+Verifying it needs only the key, so a returning browser is logged back in without
+a password check or a Firestore read; the profile cache covers the user lookup.
+Tokens issued before a user's `sessions_valid_after` (set on logout) are refused.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_KEY = "cookie_key"  # placeholder written by load_config(); never sign with it
+# Fixed (or env) rather than read from config.yaml, so the landing page can look for the
+# cookie without loading the config
+COOKIE_NAME = os.getenv("SESSION_COOKIE_NAME", "chatbot_cookie")
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def new_key():
+    return secrets.token_urlsafe(32)
+
+
+class SessionSigner:
+    def __init__(self, key, cookie_name=COOKIE_NAME, expiry_days=3):
+        self._key = key.encode("utf-8")
+        self.cookie_name = cookie_name
+        self.max_age = float(expiry_days) * 86400
+
+    def new_claims(self, user_id, now=None):
+        now = time.time() if now is None else now
+        return {"u": user_id, "iat": now, "exp": now + self.max_age}
+
+    def sign(self, claims):
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode("utf-8"))
+        mac = hmac.new(self._key, payload.encode("ascii"), hashlib.sha256).digest()
+        return f"{payload}.{_b64encode(mac)}"
+
+    def verify(self, token, now=None):
+        """The token's claims if the signature checks out and it hasn't expired, else None."""
+        if not token or token.count(".") != 1:
+            return None
+        payload, mac = token.split(".")
+        expected = hmac.new(self._key, payload.encode("ascii", "ignore"), hashlib.sha256).digest()
+        try:
+            if not hmac.compare_digest(_b64decode(mac), expected):
+                return None
+            claims = json.loads(_b64decode(payload))
+        except (ValueError, TypeError):
+            return None
+        if not isinstance(claims, dict) or not claims.get("u"):
+            return None
+        if claims.get("exp", 0) <= (time.time() if now is None else now):
+            return None
+        return claims
+
+
+def cookie_script(name, value, expires_at):
+    # Streamlit can't set response headers, so the cookie is written from a component
+    # iframe (same origin as the app). JS can't mark it HttpOnly.
+    expires = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(expires_at))
+    return (
+        "<script>"
+        f"parent.document.cookie = {json.dumps(f'{name}={value}; expires={expires}; path=/; SameSite=Strict')}"
+        " + (parent.location.protocol === 'https:' ? '; Secure' : '');"
+        "</script>"
+    )
+
+
+class ProfileCache:
+    """LRU of user profiles (password hash stripped) so resumed sessions skip Firestore."""
+
+    def __init__(self, max_entries=4096, ttl=600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # user_id -> (expires_at, profile)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry[0] <= now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, profile):
+        profile = {k: v for k, v in profile.items() if k != "password"}
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, profile)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return profile
+
+    def update(self, user_id, **fields):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                entry[1].update(fields)
+
+    def __len__(self):
+        return len(self._entries)